@@ -1,38 +1,55 @@
 #!/usr/bin/env python
 '''This program allows for unit-test like testing of salt state logic
    Author: William Cannon  william period cannon at gmail dot com'''
+import abc
 import argparse
+import io
 import json
+from xml.sax.saxutils import escape, quoteattr
 import salt.client
 import salt.client.ssh.client
 import salt.config
 import yaml
 import time
 import collections
+import heapq
 import os
 import os.path
+import re
+import shutil
+import subprocess
+import tempfile
 
 class Tester(object):
     '''
     This class implements the salt_check
     '''
 
-    def __init__(self, client='salt'):
+    def __init__(self, client='salt', ssh_pool=None):
         if client == 'ssh':
             self.salt_lc = salt.client.ssh.client.SSHClient()
             self.transport = 'ssh'
         else:
             self.salt_lc = salt.client.LocalClient()
             self.transport = 'salt'
+        # an SSHConnectionPool, to keep ssh connections open across tests
+        self.ssh_pool = ssh_pool if self.transport == 'ssh' else None
         self.results_dict = {}
         self.results_dict_summary = {}
 
-    def run_one_test(self, minion_list, test_dict):
+    def client_kwargs(self):
+        '''extra keyword arguments for every salt client call'''
+        if self.ssh_pool is None:
+            return {}
+        return {'ssh_options': self.ssh_pool.ssh_options()}
+
+    @staticmethod
+    def prepare_test(test_dict):
         '''
-        Run one salt_check test, return results
+        Unpack one salt_check test: return test name, function, args, kwargs,
+        assertion and expected return
         '''
-        results_dict = {}
-        test_name = test_dict.keys()[0]
+        test_name = list(test_dict.keys())[0]
         m_f = test_dict[test_name].get('module_and_function', None)
         t_args = test_dict[test_name].get('args', None)
         if not t_args:
@@ -53,6 +70,42 @@ class Tester(object):
         #print "args: {}".format(t_args)
         #print "kwargs---> {}".format(t_kwargs)
         #print "pillar---> {}".format(pillar_data)
+        return test_name, m_f, t_args, t_kwargs, assertion, expected_return
+
+    def check_return(self, assertion, expected_return, val):
+        '''
+        Apply an assertion to what one minion returned
+        '''
+        if assertion == "assertEqual":
+            value = self.assert_equal(expected_return, val)
+        elif assertion == "assertNotEqual":
+            value = self.assert_not_equal(expected_return, val)
+        elif assertion == "assertTrue":
+            value = self.assert_true(val)
+        elif assertion == "assertFalse":
+            value = self.assert_false(val)
+        elif assertion == "assertIn":
+            value = self.assert_in(expected_return, val)
+        elif assertion == "assertNotIn":
+            value = self.assert_not_in(expected_return, val)
+        elif assertion == "assertGreater":
+            value = self.assert_greater(expected_return, val)
+        elif assertion == "assertGreaterEqual":
+            value = self.assert_greater_equal(expected_return, val)
+        elif assertion == "assertLess":
+            value = self.assert_less(expected_return, val)
+        elif assertion == "assertLessEqual":
+            value = self.assert_less_equal(expected_return, val)
+        else:
+            value = "???"
+        return value
+
+    def run_one_test(self, minion_list, test_dict):
+        '''
+        Run one salt_check test, return results
+        '''
+        results_dict = {}
+        test_name, m_f, t_args, t_kwargs, assertion, expected_return = self.prepare_test(test_dict)
         values = self.call_salt_command(tgt=minion_list,
                                         fun=m_f,
                                         arg=t_args,
@@ -60,40 +113,68 @@ class Tester(object):
                                         expr_form='list')
         #print "returned from client: {}".format(values)
         for key, val in values.items():
-            if assertion == "assertEqual":
-                value = self.assert_equal(expected_return, val)
-                results_dict[key] = value
-            elif assertion == "assertNotEqual":
-                value = self.assert_not_equal(expected_return, val)
-                results_dict[key] = value
-            elif assertion == "assertTrue":
-                value = self.assert_true(val)
-                results_dict[key] = value
-            elif assertion == "assertFalse":
-                value = self.assert_false(val)
-                results_dict[key] = value
-            elif assertion == "assertIn":
-                value = self.assert_in(expected_return, val)
-                results_dict[key] = value
-            elif assertion == "assertNotIn":
-                value = self.assert_not_in(expected_return, val)
-                results_dict[key] = value
-            elif assertion == "assertGreater":
-                value = self.assert_greater(expected_return, val)
-                results_dict[key] = value
-            elif assertion == "assertGreaterEqual":
-                value = self.assert_greater_equal(expected_return, val)
+            value = self.check_return(assertion, expected_return, val)
+            if value != "???":
                 results_dict[key] = value
-            elif assertion == "assertLess":
-                value = self.assert_less(expected_return, val)
-                results_dict[key] = value
-            elif assertion == "assertLessEqual":
-                value = self.assert_less_equal(expected_return, val)
-                results_dict[key] = value
-            else:
-                value = "???"
         return [test_name, results_dict]
 
+    def iter_one_test(self, minion_list, test_dict):
+        '''
+        Run one salt_check test, yield (minion, result) as each minion returns
+        '''
+        test_name, m_f, t_args, t_kwargs, assertion, expected_return = self.prepare_test(test_dict)
+        if self.ssh_pool is not None:
+            self.ssh_pool.start(minion_list)
+        try:
+            returns = self.salt_lc.cmd_iter(minion_list, m_f, t_args,
+                                            expr_form='list', kwarg=t_kwargs,
+                                            **self.client_kwargs())
+            for ret in returns:
+                for minion, data in ret.items():
+                    if self.ssh_pool is not None:
+                        self.ssh_pool.touch(minion)
+                    if isinstance(data, dict) and 'ret' in data:
+                        val = data['ret']
+                    elif isinstance(data, dict) and 'return' in data:
+                        val = data['return']
+                    else:
+                        val = data
+                    value = self.check_return(assertion, expected_return, val)
+                    if value != "???":
+                        yield minion, value
+        except Exception, error:
+            print error
+        finally:
+            if self.ssh_pool is not None:
+                self.ssh_pool.finish(minion_list)
+
+    def submit(self, minions, m_f, t_args, t_kwargs):
+        '''
+        Publish one test to a list of minions without waiting for it, return the
+        job id and the minions it was published to, (None, []) if it was not published
+        '''
+        try:
+            pub = self.salt_lc.run_job(list(minions), m_f, t_args, expr_form='list',
+                                       kwarg=t_kwargs, listen=True)
+        except Exception, error:
+            print error
+            return None, []
+        if not pub or not pub.get('jid') or not pub.get('minions'):
+            return None, []
+        return pub['jid'], pub['minions']
+
+    def next_return(self, wait=1):
+        '''
+        Wait at most wait seconds for a job return on the master event bus,
+        return (job id, minion, return) or None
+        '''
+        event = self.salt_lc.event.get_event(wait=wait, tag='salt/job/', full=True)
+        if not event or '/ret/' not in event.get('tag', ''):
+            return None
+        data = event.get('data', {})
+        if 'jid' not in data or 'id' not in data:
+            return None
+        return data['jid'], data['id'], data.get('return', None)
 
     def call_salt_command(self,
                           tgt,
@@ -112,6 +193,7 @@ class Tester(object):
                 value = self.salt_lc.cmd(tgt, fun, arg, timeout,
                                      expr_form, ret, jid, kwarg, **kwargs)
             else:
+                kwargs.update(self.client_kwargs())
                 value = self.salt_lc.cmd(tgt, fun, arg, timeout,
                                      expr_form, kwarg, **kwargs)
              
@@ -316,6 +398,449 @@ class Tester(object):
         print myjson
 
 
+class FleetAggregator(object):
+    '''
+    Folds results into counters as they arrive, instead of keeping every
+    result of every minion: pass/fail counts per test and per minion, and
+    failure messages for at most top_k minions per test (the minions with
+    the most failures overall at the time they failed)
+    '''
+
+    def __init__(self, top_k=5):
+        self.top_k = top_k
+        self.tests = {}  # test name -> {'pass': n, 'fail': n}
+        self.minions = {}  # minion id -> {'pass': n, 'fail': n}
+        self.failures = {}  # test name -> heap of (minion failures, sequence, minion, message)
+        self.sequence = 0
+
+    def add(self, minion, test_name, result):
+        '''fold one result in'''
+        outcome = 'pass' if result == True else 'fail'
+        test_counts = self.tests.setdefault(test_name, {'pass': 0, 'fail': 0})
+        test_counts[outcome] += 1
+        minion_counts = self.minions.setdefault(minion, {'pass': 0, 'fail': 0})
+        minion_counts[outcome] += 1
+        if outcome == 'fail':
+            self.add_failure(minion, test_name, result, minion_counts['fail'])
+
+    def add_failure(self, minion, test_name, result, score):
+        '''keep the failure if the minion is among the top_k failing ones for the test'''
+        message = ReportWriter.failure_message(result)
+        self.sequence += 1
+        entry = (score, self.sequence, minion, message)
+        heap = self.failures.setdefault(test_name, [])
+        if len(heap) < self.top_k:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    def summary(self):
+        '''
+        Return the folded results:
+        {'tests': {test: {'pass': n, 'fail': n, 'failing_minions': {minion: message}}},
+         'minions': {'total': n, 'passing': n, 'failing': n}}
+        '''
+        tests = {}
+        for test_name, counts in self.tests.items():
+            failing = dict((minion, message) for score, seq, minion, message
+                           in self.failures.get(test_name, []))
+            tests[test_name] = {'pass': counts['pass'],
+                                'fail': counts['fail'],
+                                'failing_minions': failing}
+        failing = len([1 for counts in self.minions.values() if counts['fail']])
+        return {'tests': tests,
+                'minions': {'total': len(self.minions),
+                            'passing': len(self.minions) - failing,
+                            'failing': failing}}
+
+    def print_summary(self):
+        '''
+        Print the folded results
+        '''
+        summary = self.summary()
+        print "\nRESULTS OF TESTS ACROSS {0} MINIONS:\n ".format(summary['minions']['total'])
+        print "Minions passing all tests: {0}, failing: {1}".format(
+            summary['minions']['passing'], summary['minions']['failing'])
+        for test_name, counts in sorted(summary['tests'].items()):
+            print "Test: {0}".format(test_name).ljust(40),
+            print "Passed: {0}, Failed: {1}".format(counts['pass'], counts['fail'])
+            for minion, message in sorted(counts['failing_minions'].items()):
+                print u"    {0} --> {1}".format(ReportWriter.as_text(minion), message).encode('utf-8')
+
+
+class SSHConnectionPool(object):
+    '''
+    Keeps one multiplexed ssh connection (ControlMaster) open per salt-ssh target
+    for the whole run, so tests after the first skip the ssh handshake
+    ssh closes a connection left idle for idle_timeout seconds (ControlPersist);
+    past max_size open connections, the least recently used ones that no
+    command is running on are closed
+    '''
+
+    def __init__(self, opts, max_size=100, idle_timeout=60):
+        self.opts = opts
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        # short, as unix socket paths are limited to about 100 characters
+        self.control_dir = tempfile.mkdtemp(prefix='sc-ssh-')
+        self.last_used = {}  # target -> time of its last return
+        self.targets = {}  # target -> roster entry, read when the target is evicted
+        self.in_use = set()  # targets running a command, not closed
+
+    def ssh_options(self):
+        '''ssh -o options making salt-ssh share a connection per target'''
+        options = list(self.opts.get('ssh_options', None) or [])
+        options.extend(['ControlMaster=auto',
+                        'ControlPath={0}/%r@%h:%p'.format(self.control_dir),
+                        'ControlPersist={0}s'.format(self.idle_timeout)])
+        return options
+
+    def start(self, targets):
+        '''record that a command is running on targets'''
+        self.in_use.update(targets)
+
+    def finish(self, targets):
+        '''record that the command running on targets is done'''
+        self.in_use.difference_update(targets)
+
+    def touch(self, target):
+        '''record that a target returned, closing connections past max_size'''
+        now = time.time()
+        self.in_use.discard(target)
+        self.last_used[target] = now
+        for name, used in list(self.last_used.items()):
+            if now - used > self.idle_timeout:
+                del self.last_used[name]
+                # ssh closed it already, unless the master outlived ControlPersist
+                self.close_target(name)
+        while len(self.last_used) > self.max_size:
+            idle = [name for name in self.last_used if name not in self.in_use and name != target]
+            if not idle:
+                break
+            oldest = min(idle, key=self.last_used.get)
+            del self.last_used[oldest]
+            self.close_target(oldest)
+
+    def socket_path(self, target):
+        '''the control socket of a target, as ssh expands ControlPath'''
+        if target not in self.targets:
+            import salt.roster
+            roster = salt.roster.Roster(self.opts, self.opts.get('roster', 'flat'))
+            self.targets.update(roster.targets([target], 'list'))
+        entry = self.targets.get(target, {})
+        return os.path.join(self.control_dir, '{0}@{1}:{2}'.format(
+            entry.get('user', self.opts.get('ssh_user', 'root')),
+            entry.get('host', target),
+            entry.get('port', self.opts.get('ssh_port', 22))))
+
+    def close_target(self, target):
+        '''ask the ssh master of a target to exit'''
+        try:
+            path = self.socket_path(target)
+        except Exception, error:
+            print error
+            return
+        if os.path.exists(path):
+            subprocess.call(['ssh', '-S', path, '-O', 'exit', target],
+                            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+
+    def close(self):
+        '''close every connection and remove the control sockets'''
+        for name in os.listdir(self.control_dir):
+            subprocess.call(['ssh', '-S', os.path.join(self.control_dir, name), '-O', 'exit', 'x'],
+                            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+
+
+class RollingBatch(object):
+    '''
+    Runs the tests on at most `window` minions at a time, publishing each test once
+    to a group of minions (a list target) and sorting the returns by minion id:
+    minions started together get the next test as soon as all of them returned the
+    previous one, and new minions start, together, as soon as others finished
+    The window follows return latency: it grows (by about one per window of
+    returns, up to max_window) while latency stays close to the best seen, and
+    shrinks by a quarter when latency doubles
+    Once fail_min minions have finished, a circuit breaker stops starting new
+    minions if more than fail_rate of the finished minions failed a test
+    A minion that does not return a test within timeout, or that a test was not
+    published to, fails its remaining tests without running them
+    '''
+
+    def __init__(self, tester, minion_list, test_dict, window, max_window=None,
+                 timeout=60, fail_rate=None, fail_min=10):
+        self.tester = tester
+        self.pending = collections.deque(minion_list)
+        self.tests = [(name, tester.prepare_test({name: test})) for name, test in test_dict.items()]
+        self.window = float(self.parse_window(window, len(minion_list)))
+        if max_window:
+            self.max_window = float(max(self.parse_window(max_window, len(minion_list)), self.window))
+        else:
+            self.max_window = self.window
+        self.timeout = timeout
+        self.fail_rate = fail_rate
+        self.fail_min = fail_min
+        # job id -> {'index': test index, 'waiting': minions not returned yet,
+        #            'returned': minions to publish the next test to, 'published': time}
+        self.jobs = {}
+        self.running = set()  # minions started and not done with their tests
+        self.ready = collections.deque()  # (minion, test index, result, seconds) to report
+        self.failed_minions = set()
+        self.finished = 0
+        self.publishes = 0
+        self.latency = None
+        self.best_latency = None
+        self.cooldown = 0
+        self.tripped = False
+
+    @staticmethod
+    def parse_window(value, count):
+        '''a window of N minions, or of N% of the minions'''
+        value = str(value).strip()
+        if value.endswith('%'):
+            return max(1, int(count * float(value[:-1]) / 100))
+        return max(1, int(value))
+
+    def observe(self, latency):
+        '''adapt the window to the latency of one return'''
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * latency
+        if self.best_latency is None or self.latency < self.best_latency:
+            self.best_latency = self.latency
+        if self.cooldown > 0:
+            self.cooldown -= 1
+        elif self.latency > 2 * self.best_latency:
+            self.window = max(1.0, self.window * 0.75)
+            self.cooldown = int(self.window)
+        elif self.latency < 1.2 * self.best_latency:
+            self.window = min(self.max_window, self.window + 1.0 / self.window)
+
+    def start_minions(self):
+        '''start as many pending minions as the window has room for, with one publish'''
+        minions = []
+        while self.pending and not self.tripped and len(self.running) + len(minions) < int(self.window):
+            minions.append(self.pending.popleft())
+        if minions:
+            self.running.update(minions)
+            self.publish(minions, 0)
+
+    def publish(self, minions, index):
+        '''publish test index to a group of minions'''
+        test_name, (name, m_f, t_args, t_kwargs, assertion, expected) = self.tests[index]
+        self.publishes += 1
+        jid, targeted = self.tester.submit(minions, m_f, t_args, t_kwargs)
+        waiting = set(targeted).intersection(minions) if jid else set()
+        for minion in minions:
+            if minion not in waiting:
+                self.give_up(minion, index, "the job was not published to the minion", 0.0)
+        if waiting:
+            self.jobs[jid] = {'index': index, 'waiting': waiting, 'returned': [],
+                              'published': time.time()}
+
+    def give_up(self, minion, index, reason, latency):
+        '''fail test index and the tests after it on a minion, freeing its slot in the window'''
+        self.running.discard(minion)
+        self.ready.append((minion, index, "False: {0}".format(reason), latency))
+        for later in range(index + 1, len(self.tests)):
+            self.ready.append((minion, later, "False: not run, {0}".format(reason), 0.0))
+
+    def collect(self, returned, now):
+        '''check the return of one minion to a job, ignoring returns of no running job'''
+        jid, minion, val = returned
+        job = self.jobs.get(jid, None)
+        if job is None or minion not in job['waiting']:
+            return
+        job['waiting'].remove(minion)
+        latency = now - job['published']
+        self.observe(latency)
+        name, m_f, t_args, t_kwargs, assertion, expected = self.tests[job['index']][1]
+        self.ready.append((minion, job['index'], self.tester.check_return(assertion, expected, val),
+                           latency))
+        if job['index'] + 1 < len(self.tests):
+            job['returned'].append(minion)
+        if not job['waiting']:
+            self.complete(jid)
+
+    def complete(self, jid):
+        '''once every minion of a job returned or was given up, publish them the next test'''
+        job = self.jobs.pop(jid)
+        if job['returned']:
+            self.publish(job['returned'], job['index'] + 1)
+
+    def account(self, minion, index, result):
+        '''count a result, and the minion as finished after its last test'''
+        if result != True and result != "???":
+            self.failed_minions.add(minion)
+        if index + 1 < len(self.tests):
+            return
+        self.running.discard(minion)
+        self.finished += 1
+        if (self.fail_rate is not None and self.finished >= self.fail_min
+                and len(self.failed_minions) > self.fail_rate * self.finished):
+            self.tripped = True
+
+    def run(self):
+        '''yield (minion, test name, result, seconds) as results come in'''
+        if not self.tests:
+            return
+        while self.pending or self.jobs or self.ready:
+            if not self.ready:
+                self.start_minions()
+            if self.ready:
+                minion, index, result, latency = self.ready.popleft()
+                if result != "???":
+                    yield minion, self.tests[index][0], result, latency
+                self.account(minion, index, result)
+                continue
+            if not self.jobs:
+                break
+            # every return already waiting is collected before new minions start,
+            # so that minions freed together start together
+            returned = self.tester.next_return(wait=1)
+            now = time.time()
+            while returned is not None:
+                self.collect(returned, now)
+                returned = self.tester.next_return(wait=0)
+            self.expire(time.time())
+
+    def expire(self, now):
+        '''give up on the minions that did not return a job within timeout'''
+        for jid, job in list(self.jobs.items()):
+            if now - job['published'] > self.timeout:
+                for minion in sorted(job['waiting']):
+                    self.give_up(minion, job['index'],
+                                 "no return within {0} seconds".format(self.timeout),
+                                 now - job['published'])
+                job['waiting'].clear()
+                self.complete(jid)
+
+    def skipped(self):
+        '''minions not started because the circuit breaker tripped'''
+        return list(self.pending)
+
+
+class ReportWriter(object):
+    '''
+    Abstract base of the report writers: subclasses implement format_result
+    Writes test results to a file one at a time, as they are produced,
+    through a buffered file handle that is flushed every flush_every
+    results or flush_interval seconds, whichever comes first
+    Reports are utf-8, results are written as unicode text
+    '''
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, path, flush_every=100, flush_interval=5.0):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.myfile = io.open(path, 'w', 65536, encoding='utf-8')
+        self.unflushed = 0
+        self.last_flush = time.time()
+        self.myfile.write(self.header())
+
+    def header(self):
+        '''text written before the first result'''
+        return u''
+
+    def footer(self):
+        '''text written after the last result'''
+        return u''
+
+    @abc.abstractmethod
+    def format_result(self, minion, test_name, result, duration):
+        '''one result as unicode text'''
+
+    @staticmethod
+    def as_text(value):
+        '''value as unicode text, byte strings are read as utf-8'''
+        if isinstance(value, unicode):
+            return value
+        if isinstance(value, str):
+            return value.decode('utf-8', 'replace')
+        return unicode(value)
+
+    @classmethod
+    def failure_message(cls, result):
+        '''None for a passed test, else why it failed'''
+        if result == True:
+            return None
+        if isinstance(result, list) and len(result) > 1:
+            return cls.as_text(result[1])
+        return cls.as_text(result)
+
+    def write_result(self, minion, test_name, result, duration=None):
+        '''write one result, flushing when due'''
+        self.myfile.write(self.format_result(minion, test_name, result, duration))
+        self.unflushed += 1
+        if self.unflushed >= self.flush_every or \
+           time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        '''push buffered results to disk'''
+        self.myfile.flush()
+        self.unflushed = 0
+        self.last_flush = time.time()
+
+    def close(self):
+        '''finish and close the report file'''
+        self.myfile.write(self.footer())
+        self.myfile.close()
+
+
+class JsonLinesWriter(ReportWriter):
+    '''
+    One json object per line and result:
+    {"minion": "web1", "test": "apache-conf-exists", "result": true, "message": null, "time": 0.4}
+    '''
+
+    def format_result(self, minion, test_name, result, duration):
+        message = self.failure_message(result)
+        record = {'minion': self.as_text(minion),
+                  'test': self.as_text(test_name),
+                  'result': message is None,
+                  'message': message,
+                  'time': duration}
+        return u'{0}\n'.format(json.dumps(record))
+
+
+class JUnitXmlWriter(ReportWriter):
+    '''
+    JUnit xml, one testcase per minion and test (classname is the minion id)
+    The testsuite carries no counts, they are not known until the end
+    Control characters XML 1.0 does not allow, even escaped (such as the
+    color codes of command output), are replaced by '?'
+    '''
+    INVALID_CHARACTERS = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+    @classmethod
+    def text(cls, value):
+        '''value as unicode text that is valid in XML 1.0'''
+        return cls.INVALID_CHARACTERS.sub(u'?', cls.as_text(value))
+
+    def header(self):
+        return (u'<?xml version="1.0" encoding="UTF-8"?>\n'
+                u'<testsuites>\n'
+                u'<testsuite name="salt-check">\n')
+
+    def footer(self):
+        return u'</testsuite>\n</testsuites>\n'
+
+    def format_result(self, minion, test_name, result, duration):
+        testcase = u'<testcase classname={0} name={1}'.format(quoteattr(self.text(minion)),
+                                                              quoteattr(self.text(test_name)))
+        if duration is not None:
+            testcase += u' time="{0:.3f}"'.format(duration)
+        message = self.failure_message(result)
+        if message is None:
+            return testcase + u'/>\n'
+        message = self.text(message)
+        return u'{0}><failure message={1}>{2}</failure></testcase>\n'.format(
+            testcase, quoteattr(message), escape(message))
+
+
 class TestLoader(object):
     '''
     Class loads in test files
@@ -417,9 +942,14 @@ class TestLoader(object):
         return self.test_dict
 
 
-def main(minion_list, client_type, test_dict, verbose):
+def main(minion_list, client_type, test_dict, verbose, report_writers=(), top_k=5, rolling=None,
+         ssh_pool_size=100, ssh_idle=60):
     '''
     main entry point
+    verbose='summary' folds results as they arrive and keeps no per-minion detail
+    rolling is None, or the options of a RollingBatch (window, max_window, timeout, fail_rate, fail_min)
+    with the ssh client, connections are kept open across tests (see SSHConnectionPool)
+    unless ssh_pool_size is 0
     '''
     start_time = time.time()
     #print "minion_list: {}".format(minion_list)
@@ -429,26 +959,56 @@ def main(minion_list, client_type, test_dict, verbose):
     print
 
     tester = Tester(client=client_type)
+    if tester.transport == 'ssh' and ssh_pool_size:
+        tester.ssh_pool = SSHConnectionPool(tester.salt_lc.opts, max_size=ssh_pool_size,
+                                            idle_timeout=ssh_idle)
     tester.results_dict = {} # for holding results of all tests
-    for key, val in test_dict.items():
-        result = tester.run_one_test(minion_list, {key:val})
-        test_name = result[0]
-        k_v = result[1]
-        #print "\nTest Name:  {0}".format(test_name)
-        #print "Minion      Test-Result"
-        for ley, wal in k_v.items():
-            res = tester.results_dict.get(ley, None)
-            if not res:
-                tester.results_dict[ley] = {test_name : wal}
-            else:
-                res[test_name] = wal
-                tester.results_dict[ley] = res
-            #print "{0}         {1}".format(k, v)
-    tester.summarize_results()
-    if verbose == 'low':
-        tester.print_results_verbose_low()
+    aggregator = FleetAggregator(top_k=top_k)
+
+    def record(ley, key, wal, test_time):
+        '''one result of one minion'''
+        aggregator.add(ley, key, wal)
+        for writer in report_writers:
+            writer.write_result(ley, key, wal, test_time)
+        if verbose == 'summary':
+            return
+        res = tester.results_dict.get(ley, None)
+        if not res:
+            tester.results_dict[ley] = {key : wal}
+        else:
+            res[key] = wal
+            tester.results_dict[ley] = res
+        #print "{0}         {1}".format(k, v)
+
+    batch = None
+    try:
+        if rolling:
+            batch = RollingBatch(tester, minion_list, test_dict, **rolling)
+            for ley, key, wal, test_time in batch.run():
+                record(ley, key, wal, test_time)
+        else:
+            for key, val in test_dict.items():
+                test_start = time.time()
+                for ley, wal in tester.iter_one_test(minion_list, {key:val}):
+                    record(ley, key, wal, time.time() - test_start)
+    finally:
+        # reports get their footer and ssh masters exit even if the run failed
+        for writer in report_writers:
+            writer.close()
+        if tester.ssh_pool is not None:
+            tester.ssh_pool.close()
+    if verbose == 'summary':
+        aggregator.print_summary()
     else:
-        tester.print_results_as_text()
+        tester.summarize_results()
+        if verbose == 'low':
+            tester.print_results_verbose_low()
+        else:
+            tester.print_results_as_text()
+    if batch is not None and batch.tripped:
+        print
+        print "Circuit breaker tripped: {0} of {1} finished minions failed, {2} minions not run".format(
+            len(batch.failed_minions), batch.finished, len(batch.skipped()))
     print
     end_time = time.time()
     total_time_sec = end_time - start_time
@@ -460,7 +1020,30 @@ if __name__ == "__main__":
     PARSER.add_argument('-L', '--list', action="store", dest="L")
     PARSER.add_argument('-c', '--client', action="store", dest="c", default='salt')
     PARSER.add_argument('testfile', action="store")
-    PARSER.add_argument('-v', '--verbose', action="store", dest="verbose", default='low')
+    PARSER.add_argument('-v', '--verbose', action="store", dest="verbose", default='low',
+                        help="low, high or summary (counts only, for large fleets)")
+    PARSER.add_argument('--top-k', action="store", dest="top_k", type=int, default=5,
+                        help="in summary mode, failing minions to show per test")
+    PARSER.add_argument('--junit', action="store", dest="junit",
+                        help="stream results to this file as JUnit xml")
+    PARSER.add_argument('--jsonl', action="store", dest="jsonl",
+                        help="stream results to this file as json lines")
+    PARSER.add_argument('--flush-every', action="store", dest="flush_every", type=int, default=100,
+                        help="flush report files after this many results")
+    PARSER.add_argument('-b', '--batch', action="store", dest="batch",
+                        help="rolling batch: run at most this many minions (or N%%) at a time")
+    PARSER.add_argument('--batch-max', action="store", dest="batch_max",
+                        help="let the rolling batch window grow up to this many minions (or N%%)")
+    PARSER.add_argument('--batch-timeout', action="store", dest="batch_timeout", type=float, default=60,
+                        help="seconds to wait for a minion to return one test")
+    PARSER.add_argument('--batch-fail-rate', action="store", dest="batch_fail_rate", type=float,
+                        help="stop starting minions when more than this fraction of the finished ones failed")
+    PARSER.add_argument('--batch-fail-min', action="store", dest="batch_fail_min", type=int, default=10,
+                        help="finished minions needed before the failure rate is checked")
+    PARSER.add_argument('--ssh-pool-size', action="store", dest="ssh_pool_size", type=int, default=100,
+                        help="with -c ssh, ssh connections kept open across tests (0 to not keep any)")
+    PARSER.add_argument('--ssh-idle', action="store", dest="ssh_idle", type=int, default=60,
+                        help="with -c ssh, seconds an unused ssh connection stays open")
     ARGS = PARSER.parse_args()
     #print "list: {0}".format(args.L)
     #print "verbose: {0}".format(args.verbose)
@@ -473,7 +1056,23 @@ if __name__ == "__main__":
         MINION_LIST_STR = ARGS.L
         MY_MINION_LIST = MINION_LIST_STR.split(",")
         #print "minion_list: {0}".format(minion_list)
-        main(minion_list=MY_MINION_LIST, client_type=ARGS.c, test_dict=MYDICT, verbose=ARGS.verbose)
+        REPORT_WRITERS = []
+        if ARGS.junit:
+            REPORT_WRITERS.append(JUnitXmlWriter(ARGS.junit, flush_every=ARGS.flush_every))
+        if ARGS.jsonl:
+            REPORT_WRITERS.append(JsonLinesWriter(ARGS.jsonl, flush_every=ARGS.flush_every))
+        ROLLING = None
+        if ARGS.batch:
+            if ARGS.c == 'ssh':
+                PARSER.error("--batch needs the salt client, salt-ssh has no event bus")
+            ROLLING = {'window': ARGS.batch,
+                       'max_window': ARGS.batch_max,
+                       'timeout': ARGS.batch_timeout,
+                       'fail_rate': ARGS.batch_fail_rate,
+                       'fail_min': ARGS.batch_fail_min}
+        main(minion_list=MY_MINION_LIST, client_type=ARGS.c, test_dict=MYDICT, verbose=ARGS.verbose,
+             report_writers=REPORT_WRITERS, top_k=ARGS.top_k, rolling=ROLLING,
+             ssh_pool_size=ARGS.ssh_pool_size, ssh_idle=ARGS.ssh_idle)
     else:
         print "A list of minions to target must be provided"
         print "e.g.  salt_check.py testfile.tst -L web,cnc"
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+import collections
+import imp
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import xml.dom.minidom
+
+# salt-check-runner.py is not importable by name
+RUNNER = imp.load_source('salt_check_runner', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'salt-check-runner.py'))
+
+# Note: the order tests are run is arbitrary!
+
+
+class ReportWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'report')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def on_disk(self):
+        with open(self.path) as myfile:
+            return myfile.read()
+
+    def test_report_writer_1(self):
+        self.assertRaises(TypeError, RUNNER.ReportWriter, self.path)
+
+    def test_junit_1(self):
+        writer = RUNNER.JUnitXmlWriter(self.path)
+        writer.write_result('web<1>', 'a&b', True, 0.5)
+        writer.write_result('web2', 'a"b', [False, 'got <x> & "\x1b[31mred\x1b[0m\x00"'], 1)
+        writer.close()
+        contents = self.on_disk()
+        self.assertTrue(contents.endswith('</testsuite>\n</testsuites>\n'))
+        testcases = xml.dom.minidom.parseString(contents).getElementsByTagName('testcase')
+        self.assertEqual(['web<1>', 'web2'], [case.getAttribute('classname') for case in testcases])
+        self.assertEqual(['a&b', 'a"b'], [case.getAttribute('name') for case in testcases])
+        self.assertEqual('0.500', testcases[0].getAttribute('time'))
+        self.assertEqual([], testcases[0].getElementsByTagName('failure'))
+        failure = testcases[1].getElementsByTagName('failure')[0]
+        self.assertEqual(u'got <x> & "?[31mred?[0m?"', failure.getAttribute('message'))
+        self.assertEqual(u'got <x> & "?[31mred?[0m?"', failure.firstChild.data)
+
+    def test_junit_3(self):
+        writer = RUNNER.JUnitXmlWriter(self.path)
+        writer.write_result(u'web\xe9', 'caf\xc3\xa9', [False, AssertionError(u'\u2603 is not equal to x')])
+        writer.close()
+        testcase = xml.dom.minidom.parse(self.path).getElementsByTagName('testcase')[0]
+        self.assertEqual(u'web\xe9', testcase.getAttribute('classname'))
+        self.assertEqual(u'caf\xe9', testcase.getAttribute('name'))
+        failure = testcase.getElementsByTagName('failure')[0]
+        self.assertEqual(u'\u2603 is not equal to x', failure.getAttribute('message'))
+
+    def test_jsonl_2(self):
+        writer = RUNNER.JsonLinesWriter(self.path)
+        writer.write_result(u'web\xe9', u'test\u2603', u'False: \xe9')
+        writer.close()
+        record = json.loads(self.on_disk())
+        self.assertEqual([u'web\xe9', u'test\u2603', u'False: \xe9'],
+                         [record['minion'], record['test'], record['message']])
+
+    def test_junit_2(self):
+        self.assertEqual(u'tab\tnew\nline\xe9?',
+                         RUNNER.JUnitXmlWriter.text(u'tab\tnew\nline\xe9\x07'))
+        self.assertEqual('5', RUNNER.JUnitXmlWriter.text(5))
+
+    def test_jsonl_1(self):
+        writer = RUNNER.JsonLinesWriter(self.path)
+        writer.write_result('web1', 'test1', True, 0.5)
+        writer.write_result('web2', 'test1', [False, 'no "x"\n'])
+        writer.close()
+        records = [json.loads(line) for line in self.on_disk().splitlines()]
+        self.assertEqual([{'minion': 'web1', 'test': 'test1', 'result': True,
+                           'message': None, 'time': 0.5},
+                          {'minion': 'web2', 'test': 'test1', 'result': False,
+                           'message': 'no "x"\n', 'time': None}], records)
+
+    def test_main_1(self):
+        class FailingTester(FakeTester):
+            def __init__(self, client='salt'):
+                FakeTester.__init__(self)
+                self.transport = client
+                self.ssh_pool = None
+
+            def iter_one_test(self, minion_list, test_dict):
+                raise RuntimeError('lost the master')
+
+        writer = RUNNER.JUnitXmlWriter(self.path)
+        tester = RUNNER.Tester
+        RUNNER.Tester = FailingTester
+        try:
+            self.assertRaises(RuntimeError, RUNNER.main, ['web1'], 'salt', {'test1': {}}, 'low',
+                              report_writers=[writer])
+        finally:
+            RUNNER.Tester = tester
+        self.assertTrue(self.on_disk().endswith('</testsuite>\n</testsuites>\n'))
+
+    def test_flush_every_1(self):
+        writer = RUNNER.JsonLinesWriter(self.path, flush_every=2, flush_interval=3600)
+        writer.write_result('web1', 'test1', True)
+        self.assertEqual('', self.on_disk())
+        writer.write_result('web2', 'test1', True)
+        self.assertEqual(2, len(self.on_disk().splitlines()))
+        writer.write_result('web3', 'test1', True)
+        self.assertEqual(2, len(self.on_disk().splitlines()))
+        writer.close()
+        self.assertEqual(3, len(self.on_disk().splitlines()))
+
+    def test_flush_interval_1(self):
+        writer = RUNNER.JUnitXmlWriter(self.path, flush_every=100, flush_interval=3600)
+        writer.write_result('web1', 'test1', True)
+        self.assertEqual('', self.on_disk())
+        writer.flush_interval = 0
+        writer.write_result('web2', 'test1', True)
+        contents = self.on_disk()
+        self.assertTrue(contents.startswith('<?xml'))
+        self.assertEqual(2, contents.count('<testcase '))
+        self.assertFalse('</testsuites>' in contents)
+        writer.close()
+        self.assertTrue(self.on_disk().endswith('</testsuite>\n</testsuites>\n'))
+
+
+class FleetAggregatorTests(unittest.TestCase):
+
+    def test_add_failure_1(self):
+        aggregator = RUNNER.FleetAggregator(top_k=2)
+        aggregator.add('web1', 'test1', [False, 'web1 failed'])
+        aggregator.add('web2', 'test1', [False, 'web2 failed'])
+        # web3 fails test2 first, so it ranks above web1 and web2 for test1
+        aggregator.add('web3', 'test2', False)
+        aggregator.add('web3', 'test1', [False, 'web3 failed'])
+        failing = aggregator.summary()['tests']['test1']['failing_minions']
+        self.assertEqual({'web2': 'web2 failed', 'web3': 'web3 failed'}, failing)
+
+    def test_add_failure_2(self):
+        aggregator = RUNNER.FleetAggregator(top_k=2)
+        aggregator.add('web1', 'test2', False)
+        aggregator.add('web1', 'test1', [False, 'web1 failed'])
+        aggregator.add('web2', 'test2', False)
+        aggregator.add('web2', 'test1', [False, 'web2 failed'])
+        # a minion with fewer failures does not replace any
+        aggregator.add('web3', 'test1', [False, 'web3 failed'])
+        failing = aggregator.summary()['tests']['test1']['failing_minions']
+        self.assertEqual({'web1': 'web1 failed', 'web2': 'web2 failed'}, failing)
+        self.assertEqual(3, aggregator.summary()['tests']['test1']['fail'])
+
+    def test_summary_1(self):
+        aggregator = RUNNER.FleetAggregator()
+        aggregator.add('web1', 'test1', True)
+        aggregator.add('web1', 'test2', True)
+        aggregator.add('web2', 'test1', True)
+        aggregator.add('web2', 'test2', 'False: no return')
+        aggregator.add('web3', 'test1', [False, 'nope'])
+        aggregator.add('web3', 'test2', [False, 'nope'])
+        summary = aggregator.summary()
+        self.assertEqual({'total': 3, 'passing': 1, 'failing': 2}, summary['minions'])
+        self.assertEqual({'pass': 2, 'fail': 1, 'failing_minions': {'web3': 'nope'}},
+                         summary['tests']['test1'])
+        self.assertEqual({'pass': 1, 'fail': 2,
+                          'failing_minions': {'web2': 'False: no return', 'web3': 'nope'}},
+                         summary['tests']['test2'])
+
+    def test_summary_3(self):
+        aggregator = RUNNER.FleetAggregator()
+        aggregator.add(u'web\xe9', 'test1', [False, AssertionError(u'\u2603')])
+        self.assertEqual({u'web\xe9': u'\u2603'},
+                         aggregator.summary()['tests']['test1']['failing_minions'])
+
+    def test_summary_2(self):
+        self.assertEqual({'tests': {}, 'minions': {'total': 0, 'passing': 0, 'failing': 0}},
+                         RUNNER.FleetAggregator().summary())
+
+
+class SSHConnectionPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = RUNNER.SSHConnectionPool({}, max_size=2, idle_timeout=60)
+        self.closed = []
+        self.pool.close_target = self.closed.append
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_ssh_options_1(self):
+        self.pool.opts = {'ssh_options': ['Compression=yes']}
+        options = self.pool.ssh_options()
+        self.assertEqual(['Compression=yes', 'ControlMaster=auto'], options[:2])
+        self.assertTrue(options[2].startswith('ControlPath=' + self.pool.control_dir + '/'))
+        self.assertEqual('ControlPersist=60s', options[3])
+
+    def test_touch_1(self):
+        for target in ['web1', 'web2', 'web3']:
+            self.pool.touch(target)
+        self.assertEqual(['web1'], self.closed)
+        self.assertEqual(set(['web2', 'web3']), set(self.pool.last_used))
+        self.pool.touch('web2')
+        self.pool.touch('web4')
+        self.assertEqual(['web1', 'web3'], self.closed)
+
+    def test_touch_2(self):
+        self.pool.touch('web1')
+        self.pool.touch('web2')
+        self.pool.last_used['web1'] -= 61
+        self.pool.last_used['web2'] -= 59
+        self.pool.touch('web3')
+        self.assertEqual(['web1'], self.closed)
+        self.assertEqual(set(['web2', 'web3']), set(self.pool.last_used))
+
+    def test_touch_3(self):
+        # a command is running on web1: web2 is the oldest idle connection
+        self.pool.touch('web1')
+        self.pool.touch('web2')
+        self.pool.start(['web1', 'web3', 'web4'])
+        self.pool.touch('web3')
+        self.assertEqual(['web2'], self.closed)
+        # web3 returned, so it is idle again
+        self.pool.touch('web4')
+        self.assertEqual(['web2', 'web3'], self.closed)
+        self.assertEqual(set(['web1', 'web4']), set(self.pool.last_used))
+        self.pool.finish(['web1', 'web3', 'web4'])
+        self.pool.touch('web3')
+        self.assertEqual(['web2', 'web3', 'web1'], self.closed)
+
+
+class FakeTester(RUNNER.Tester):
+    '''a Tester whose minions in `returning` return True at once, and the others never'''
+
+    def __init__(self, returning=(), matched=None):
+        self.returning = set(returning)
+        self.matched = matched  # minions a job can be published to, None for all
+        self.submitted = []  # (minions, function) per published job
+        self.outstanding = collections.deque()
+
+    def submit(self, minions, m_f, t_args, t_kwargs):
+        targeted = [minion for minion in minions if self.matched is None or minion in self.matched]
+        if not targeted:
+            return None, []
+        self.submitted.append((tuple(minions), m_f))
+        jid = str(len(self.submitted))
+        for minion in targeted:
+            if minion in self.returning:
+                self.outstanding.append((jid, minion, True))
+        return jid, targeted
+
+    def next_return(self, wait=1):
+        if self.outstanding:
+            return self.outstanding.popleft()
+        if wait:
+            time.sleep(0.01)
+        return None
+
+
+class RollingBatchTests(unittest.TestCase):
+
+    TESTS = collections.OrderedDict(
+        ('test{0}'.format(n), {'module_and_function': 'test.fun{0}'.format(n),
+                               'assertion': 'assertTrue'})
+        for n in range(3))
+
+    def test_parse_window_1(self):
+        parse_window = RUNNER.RollingBatch.parse_window
+        self.assertEqual(3, parse_window('3', 50))
+        self.assertEqual(3, parse_window(3, 50))
+        self.assertEqual(5, parse_window('10%', 50))
+        self.assertEqual(2, parse_window(' 25% ', 10))
+        self.assertEqual(1, parse_window('1%', 50))
+        self.assertEqual(1, parse_window('0', 50))
+        self.assertRaises(ValueError, parse_window, 'x', 50)
+
+    def test_observe_1(self):
+        batch = RUNNER.RollingBatch(FakeTester(), ['web1'], self.TESTS, window=2, max_window=4)
+        for _ in range(20):
+            batch.observe(1.0)
+        self.assertEqual(4.0, batch.window)
+        # latency more than doubled: shrink by a quarter, then hold for a window of returns
+        batch.observe(10.0)
+        self.assertEqual(3.0, batch.window)
+        self.assertEqual(3, batch.cooldown)
+        for _ in range(3):
+            batch.observe(1.0)
+        self.assertEqual(3.0, batch.window)
+        for _ in range(40):
+            batch.observe(1.0)
+        self.assertEqual(4.0, batch.window)
+
+    def test_observe_2(self):
+        batch = RUNNER.RollingBatch(FakeTester(), ['web1'] * 10, self.TESTS, window='20%')
+        for _ in range(5):
+            batch.observe(1.0)
+        self.assertEqual(2.0, batch.window)
+
+    def test_expire_1(self):
+        batch = RUNNER.RollingBatch(FakeTester(returning=['web2']), ['web1', 'web2', 'web3'],
+                                    self.TESTS, window=2, timeout=10)
+        batch.publish(['web1', 'web2'], 0)
+        batch.publish(['web3'], 1)
+        jid = [key for key, job in batch.jobs.items() if job['index'] == 0][0]
+        batch.collect(batch.tester.next_return(), time.time())
+        batch.ready.clear()
+        batch.jobs[jid]['published'] -= 11
+        batch.expire(time.time())
+        self.assertEqual([('web1', 0, 'False: no return within 10 seconds'),
+                          ('web1', 1, 'False: not run, no return within 10 seconds'),
+                          ('web1', 2, 'False: not run, no return within 10 seconds')],
+                         [entry[:3] for entry in batch.ready])
+        self.assertTrue(batch.ready[0][3] > 10)
+        # web3 has time left, web2 returned and gets the next test
+        self.assertEqual([(1, set(['web2'])), (1, set(['web3']))],
+                         sorted((job['index'], job['waiting']) for job in batch.jobs.values()))
+
+    def test_collect_1(self):
+        batch = RUNNER.RollingBatch(FakeTester(), ['web1', 'web2'], self.TESTS, window=2)
+        batch.publish(['web1', 'web2'], 0)
+        jid = list(batch.jobs)[0]
+        batch.collect(('other-job', 'web1', True), time.time())
+        batch.collect((jid, 'web3', True), time.time())
+        batch.collect((jid, 'web1', False), time.time())
+        batch.collect((jid, 'web1', True), time.time())
+        self.assertEqual([('web1', 0, False)], [(minion, index, result is True)
+                                                 for minion, index, result, latency in batch.ready])
+        # the next test waits for web2
+        self.assertEqual([jid], list(batch.jobs))
+        batch.collect((jid, 'web2', True), time.time())
+        self.assertEqual([(1, set(['web1', 'web2']))],
+                         [(job['index'], job['waiting']) for job in batch.jobs.values()])
+        self.assertEqual(2, batch.publishes)
+
+    def test_run_1(self):
+        tester = FakeTester(returning=['web2'])
+        batch = RUNNER.RollingBatch(tester, ['web1', 'web2'], self.TESTS, window=1, timeout=0)
+        results = [(minion, test_name, result) for minion, test_name, result, latency in batch.run()]
+        self.assertEqual([('web1', 'test0', 'False: no return within 0 seconds'),
+                          ('web1', 'test1', 'False: not run, no return within 0 seconds'),
+                          ('web1', 'test2', 'False: not run, no return within 0 seconds'),
+                          ('web2', 'test0', True),
+                          ('web2', 'test1', True),
+                          ('web2', 'test2', True)], results)
+        # nothing more is published to a minion that timed out
+        self.assertEqual([(('web1',), 'test.fun0'), (('web2',), 'test.fun0'),
+                          (('web2',), 'test.fun1'), (('web2',), 'test.fun2')], tester.submitted)
+        self.assertEqual(2, batch.finished)
+        self.assertEqual(set(['web1']), batch.failed_minions)
+
+    def test_run_2(self):
+        tester = FakeTester(returning=['web1', 'web2'], matched=['web2'])
+        batch = RUNNER.RollingBatch(tester, ['web1', 'web2'], self.TESTS, window=2)
+        results = [(minion, test_name, result) for minion, test_name, result, latency in batch.run()]
+        reason = 'the job was not published to the minion'
+        self.assertEqual([('web1', 'test0', 'False: ' + reason),
+                          ('web1', 'test1', 'False: not run, ' + reason),
+                          ('web1', 'test2', 'False: not run, ' + reason)],
+                         [result for result in results if result[0] == 'web1'])
+        self.assertEqual([('web1', 'web2'), ('web2',), ('web2',)],
+                         [minions for minions, m_f in tester.submitted])
+        self.assertEqual(2, batch.finished)
+
+    def test_run_4(self):
+        # one publish per test and group of minions, not per minion
+        minions = ['web{0}'.format(n) for n in range(8)]
+        tester = FakeTester(returning=minions)
+        batch = RUNNER.RollingBatch(tester, minions, self.TESTS, window=4)
+        # the fake returns in microseconds, too noisy to adapt the window to
+        batch.observe = lambda latency: None
+        results = list(batch.run())
+        self.assertEqual(24, len(results))
+        self.assertTrue(all(result is True for minion, test_name, result, latency in results))
+        self.assertEqual([(tuple(minions[:4]), 'test.fun0'), (tuple(minions[:4]), 'test.fun1'),
+                          (tuple(minions[:4]), 'test.fun2'), (tuple(minions[4:]), 'test.fun0'),
+                          (tuple(minions[4:]), 'test.fun1'), (tuple(minions[4:]), 'test.fun2')],
+                         tester.submitted)
+        self.assertEqual(6, batch.publishes)
+        self.assertEqual(8, batch.finished)
+
+    def test_run_3(self):
+        tester = FakeTester(returning=[])
+        batch = RUNNER.RollingBatch(tester, ['web{0}'.format(n) for n in range(20)], self.TESTS,
+                                    window=2, timeout=0, fail_rate=0.5, fail_min=4)
+        results = list(batch.run())
+        # every minion that timed out counts once, minions already started still finish
+        self.assertTrue(batch.tripped)
+        self.assertTrue(4 <= batch.finished < 20)
+        self.assertEqual(batch.finished, len(batch.failed_minions))
+        self.assertEqual(3 * batch.finished, len(results))
+        self.assertEqual(20, batch.finished + len(batch.skipped()))
+
+
+if __name__ == '__main__':
+    unittest.main()
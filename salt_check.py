@@ -8,6 +8,13 @@
    Create a sub-directory of the state directory and name it 'salt-check-tests' (e.g. /srv/salt/apache/salt-check-tests)
    Put one or more test files in the 'salt-check-tests' directory, each with a file name ending with .tst .
    Note:  a test file contains 1 or more tests defined in yaml
+   Tests of one sls of a state go in a sub-directory named after it (e.g.
+   /srv/salt/apache/salt-check-tests/vhost_web1 for apache.vhost_web1), and
+   run_highstate_tests only runs the tests of the sls in the minion's top
+   A yaml test file starting with a #!jinja|yaml line is a jinja template using
+   grains and pillar, e.g. one test per vhost with {% for vhost in pillar['vhosts'] %}
+   Tests may also be written as .json (one object, or a list of objects) or
+   .msgpack (one or more packed objects) files, with the same layout as yaml.
 
    Three ways to run tests:
    ------------------------
@@ -24,6 +31,29 @@
    Method 3: Test highstate logic dynamically
    salt '*' salt_check.run_highstate_tests
 
+   Checking test files without running them:
+   ------------------------------------------
+   salt '*' salt_check.validate_state_tests apache
+   salt '*' salt_check.validate_highstate_tests
+
+   Splitting a run across parallel workers:
+   ----------------------------------------
+   salt-call salt_check.run_highstate_tests shard=1/4 --out=json > shard1.json
+   ...
+   salt-call salt_check.run_highstate_tests shard=4/4 --out=json > shard4.json
+   salt-call --local salt_check.merge_shards shard1.json shard2.json shard3.json shard4.json
+
+   Each shard runs a deterministic subset of the tests (picked by a stable
+   hash of state and test name). Passing shard_weights=/path/to/durations.json
+   (a copy of the durations recorded in the minion cachedir under
+   salt_check/durations.json) balances the shards by recorded run time.
+
+   Keeping a history of runs:
+   --------------------------
+   With salt_check_history: True in the minion config (or history=True) every
+   result is recorded in salt_check/history.db in the minion cachedir.
+   salt '*' salt_check.history slowest|flakiest|changed
+
    YAML Syntax for one test (replace text in caps):
    ------------------------------------------------
    UNIQUE-TEST-NAME:
@@ -42,6 +72,19 @@
                 assertIn     | assertGreater  | assertGreaterEqual |
                 assertLess   | assertLessEqual ]
      expected-return: RETURN_FROM_CALLING_SALT_EXECUTION_MODULE.FUNCTION_NAME
+     pillar-data:
+       OPTIONAL PILLAR OVERRIDE, A DICTIONARY PASSED AS pillar=
+     tags:
+       - OPTIONAL TAGS, TO RUN A SUBSET OF TESTS WITH tags=TAG
+     sls: OPTIONAL, THE SLS (OR LIST OF SLS) THE TEST BELONGS TO, e.g. apache.vhost_web1
+     cacheable: OPTIONAL, True TO REUSE THE RETURN OF A READ-ONLY CHECK ACROSS RUNS
+     cache_ttl: OPTIONAL, SECONDS TO KEEP THE RETURN (IMPLIES cacheable)
+     duration: OPTIONAL, EXPECTED SECONDS, ORDERS TESTS NOT YET TIMED
+     resource_class: OPTIONAL, LIMITS HOW MANY TESTS OF THE CLASS RUN AT ONCE (e.g. pkg)
+     eventually: OPTIONAL, RETRY UNTIL IT PASSES: True, A TIMEOUT IN SECONDS, OR
+       {timeout: 30, interval: 1, backoff: 2, max_interval: 10}
+     only_if_grains: OPTIONAL, RUN ONLY IF EVERY GRAIN MATCHES, e.g. {os_family: Debian}
+     unless_grains: OPTIONAL, SKIP IF EVERY GRAIN MATCHES, e.g. {os: [CentOS, Rocky]}
 
    Quick example of a salt_check test:
    ----------------------------------- 
@@ -53,30 +96,335 @@
     assertion: assertEqual
     expected-return: True'''
 
+# salt itself is only imported where it is used: the loader imports this module
+# on every minion start and sys.list_modules, and that has to stay cheap
 import os
 import os.path
+import collections
+import fnmatch
+import functools
+import hashlib
+import itertools
+import json
 import yaml
-import salt.client
-import salt.minion
-import salt.config
-import salt.loader
-import salt.exceptions
 import logging
+import threading
 import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# use the fastest parsers available for each test file format
+try:
+    import ujson
+    json_loads = ujson.loads
+except ImportError:
+    json_loads = json.loads
+try:
+    import msgpack
+    HAS_MSGPACK = True
+except ImportError:
+    HAS_MSGPACK = False
+YamlSafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+try:
+    string_types = (str, unicode)
+except NameError:
+    string_types = (str,)
 
 log = logging.getLogger(__name__)
 
+# test file extension -> format
+TEST_FILE_FORMATS = {'.tst': 'yaml',
+                     '.json': 'json',
+                     '.msgpack': 'msgpack'}
+
+class SaltFunctionCaller(object):
+    '''
+    Calls functions of an already loaded salt function dictionary (__salt__),
+    in the same way as salt.client.Caller.function, without loading them again
+    '''
+
+    def __init__(self, functions):
+        self.functions = functions
+
+    def function(self, fun, *args, **kwargs):
+        '''Call a salt function, e.g. function('test.echo', 'hi')'''
+        func, args, kwargs = self.resolve(fun, args, kwargs)
+        return func(*args, **kwargs)
+
+    def resolve(self, fun, args, kwargs):
+        '''return the function, args and kwargs function() would call'''
+        import salt.minion
+        import salt.utils.args
+        func = self.functions[fun]
+        args, kwargs = salt.minion.load_args_and_kwargs(
+            func,
+            salt.utils.args.parse_input(args, kwargs=kwargs))
+        return func, args, kwargs
+
+
+class PillarCache(object):
+    '''
+    Pillar rendered with the pillar-data of tests, one render per distinct
+    pillar-data (keyed by a hash of it) however many tests use it
+    pillar.items, pillar.get and pillar.item tests are answered from the
+    rendered pillar, other functions get the pillar-data as a pillar kwarg
+    '''
+
+    def __init__(self, scheck):
+        self.scheck = scheck
+        self.rendered = {}
+        self.lock = threading.Lock()
+        self.renders = 0
+
+    @staticmethod
+    def make_key(pillar_data):
+        '''the same pillar-data shares a rendered pillar'''
+        return hashlib.md5(json.dumps(pillar_data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def can_answer(fun, args, kwargs):
+        '''True if a pillar function call can be answered from a rendered pillar'''
+        if kwargs or not all(isinstance(arg, string_types) for arg in args):
+            return False
+        if fun == 'pillar.items':
+            return not args
+        if fun == 'pillar.get':
+            return len(args) in (1, 2)
+        return fun == 'pillar.item'
+
+    def render(self, pillar_data):
+        '''the pillar rendered with pillar_data, rendered on first use'''
+        key = self.make_key(pillar_data)
+        with self.lock:
+            if key not in self.rendered:
+                self.renders += 1
+                self.rendered[key] = self.scheck.call_salt_command(fun='pillar.items',
+                                                                   args=None,
+                                                                   kwargs={'pillar': pillar_data})
+            return self.rendered[key]
+
+    @staticmethod
+    def traverse(data, key, default, delimiter=':'):
+        '''look up a nested key like salt.utils.data.traverse_dict_and_list'''
+        ptr = data
+        for each in key.split(delimiter):
+            if isinstance(ptr, list):
+                try:
+                    index = int(each)
+                except ValueError:
+                    index = each
+                for embedded in [item for item in ptr if isinstance(item, dict)]:
+                    if index in embedded:
+                        ptr = embedded[index]
+                        break
+                else:
+                    if isinstance(index, string_types):
+                        return default
+                    try:
+                        ptr = ptr[index]
+                    except IndexError:
+                        return default
+            else:
+                try:
+                    ptr = ptr[each]
+                except (KeyError, TypeError):
+                    return default
+        return ptr
+
+    def call(self, fun, pillar_data, *args):
+        '''answer pillar.items / pillar.get / pillar.item from the rendered pillar'''
+        pillar = self.render(pillar_data)
+        if not isinstance(pillar, dict):
+            return pillar
+        if fun == 'pillar.items':
+            return pillar
+        if fun == 'pillar.get':
+            default = args[1] if len(args) > 1 else ''
+            return self.traverse(pillar, args[0], default)
+        return dict((arg, self.traverse(pillar, arg, '')) for arg in args)
+
+
+class SpilledReturn(object):
+    '''
+    A large string return moved to a temporary file once the salt function returned it
+    Compares (==, !=, in) by streaming over the file, and shows as its size and
+    sha256 digest, so test results reference it rather than carry it
+    The salt function still builds the whole return in memory, so this does not lower
+    peak memory; it only keeps the return out of memory while it is checked and out
+    of the results kept for the rest of the run
+    '''
+    DEFAULT_SIZE = 1024 * 1024  # characters, see the salt_check_spill_size minion option
+    CHUNK_SIZE = 65536
+    __hash__ = None
+
+    def __init__(self, returned, spill_dir):
+        import tempfile
+        self.kind = type(returned)
+        try:
+            os.makedirs(spill_dir)
+        except OSError:
+            if not os.path.isdir(spill_dir):
+                raise
+        handle, self.path = tempfile.mkstemp(prefix='return-', dir=spill_dir)
+        digest = hashlib.sha256()
+        self.size = 0
+        with os.fdopen(handle, 'wb') as myfile:
+            for start in range(0, len(returned), self.CHUNK_SIZE):
+                chunk = self.encode(returned[start:start + self.CHUNK_SIZE])
+                digest.update(chunk)
+                myfile.write(chunk)
+                self.size += len(chunk)
+        self.digest = digest.hexdigest()
+
+    def __str__(self):
+        return "<return of {0} bytes, sha256 {1}>".format(self.size, self.digest)
+
+    __repr__ = __str__
+
+    @staticmethod
+    def encode(value):
+        '''utf-8 bytes of a string'''
+        return value if isinstance(value, bytes) else value.encode('utf-8')
+
+    def iter_chunks(self):
+        '''yield the return as bytes, a chunk at a time'''
+        with open(self.path, 'rb') as myfile:
+            for chunk in iter(functools.partial(myfile.read, self.CHUNK_SIZE), b''):
+                yield chunk
+
+    def read(self):
+        '''the whole return, for comparisons that cannot stream'''
+        with open(self.path, 'rb') as myfile:
+            contents = myfile.read()
+        return contents if self.kind is bytes else contents.decode('utf-8')
+
+    def __eq__(self, other):
+        if isinstance(other, SpilledReturn):
+            return self.digest == other.digest
+        if not isinstance(other, string_types):
+            return False
+        other = self.encode(other)
+        if len(other) != self.size:
+            return False
+        position = 0
+        for chunk in self.iter_chunks():
+            if other[position:position + len(chunk)] != chunk:
+                return False
+            position += len(chunk)
+        return True
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __contains__(self, item):
+        if not isinstance(item, string_types):
+            raise TypeError("'in <string>' requires string as left operand")
+        needle = self.encode(item)
+        if not needle:
+            return True
+        tail = b''
+        for chunk in self.iter_chunks():
+            window = tail + chunk
+            if needle in window:
+                return True
+            tail = window[len(window) - len(needle) + 1:]
+        return False
+
+    def __lt__(self, other):
+        return self.read() < other
+
+    def __le__(self, other):
+        return self.read() <= other
+
+    def __gt__(self, other):
+        return self.read() > other
+
+    def __ge__(self, other):
+        return self.read() >= other
+
+    def discard(self):
+        '''remove the temporary file'''
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class CompiledTest(collections.namedtuple('CompiledTest', ['name', 'test_dict', 'valid',
+                                                           'func', 'args', 'kwargs',
+                                                           'assert_func', 'takes_returned',
+                                                           'expected', 'expected_casts'])):
+    '''
+    A test ready to run, made by SaltCheck.compile_test: validated, with the salt
+    function resolved, the assertion looked up and the expected return cast to the
+    usual types of salt returns (expected_casts, pairs of type and cast value)
+    Checking a return never changes a compiled test, so it can be shared by threads
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def invalid(cls, name, test_dict):
+        '''a test that is not run'''
+        return cls(name, test_dict, False, None, (), {}, None, False, None, ())
+
+    def call(self):
+        '''Call the salt function, an error is returned rather than raised'''
+        try:
+            return self.func(*self.args, **self.kwargs)
+        except Exception as err:
+            return err
+
+    def expected_for(self, returned):
+        '''the expected return, cast to the type of returned'''
+        if isinstance(returned, SpilledReturn):
+            returned = returned.kind()
+        ret_type = type(returned)
+        for cast_type, expected in self.expected_casts:
+            if cast_type is ret_type:
+                return expected
+        return SaltCheck.cast_expected_to_returned_type(self.expected, returned)
+
+    def check(self, returned):
+        '''Apply the assertion to what the salt function returned'''
+        expected = self.expected_for(returned)
+        if self.takes_returned:
+            return self.assert_func(expected, returned)
+        return self.assert_func(expected)
+
+
 class SaltCheck(object):
     '''
     This class implements the salt_check
     '''
 
+    # assertion -> (method, whether it compares with the return)
+    # assertTrue / assertFalse only look at the expected return cast to the returned type
+    ASSERTIONS = {'assertEqual': ('assert_equal', True),
+                  'assertNotEqual': ('assert_not_equal', True),
+                  'assertTrue': ('assert_true', False),
+                  'assertFalse': ('assert_false', False),
+                  'assertIn': ('assert_in', True),
+                  'assertNotIn': ('assert_not_in', True),
+                  'assertGreater': ('assert_greater', True),
+                  'assertGreaterEqual': ('assert_greater_equal', True),
+                  'assertLess': ('assert_less', True),
+                  'assertLessEqual': ('assert_less_equal', True)}
+    # types of salt returns the expected return is cast to when a test is compiled
+    RETURN_TYPES = (bool, int, float) + string_types + (list, dict)
+    # polling of tests with "eventually", see check_eventually
+    EVENTUALLY = {'timeout': 30, 'interval': 1, 'backoff': 2, 'max_interval': 10}
+
     def __init__(self, opts=None):
         if opts:
             self.opts = opts
         else:
             self.opts = __opts__
-        self.salt_lc = salt.client.Caller(mopts=self.opts)
+        self.salt_lc = self.get_salt_caller(opts)
+        self.functions = {}  # module name -> functions, from sys.list_functions
+        self.pillar_cache = PillarCache(self)
         self.results_dict = {}
         self.results_dict_summary = {}
         self.assertions_list = '''assertEqual assertNotEqual
@@ -86,6 +434,19 @@ class SaltCheck(object):
                                   assertLess assertLessEqual'''.split()
         self.modules = self.populate_salt_modules_list()
 
+    def get_salt_caller(self, opts=None):
+        '''
+        When running as an execution module call functions through the already
+        loaded __salt__, else (standalone, or with opts given) through a salt Caller
+        '''
+        if not opts:
+            try:
+                return SaltFunctionCaller(__salt__)
+            except NameError:
+                pass
+        import salt.client
+        return salt.client.Caller(mopts=self.opts)
+
     def cache_master_files(self):
         ''' equivalent to a salt cli: salt web cp.cache_master
         note: should do this for each env in file_root'''
@@ -106,24 +467,37 @@ class SaltCheck(object):
         return returned
 
     def get_top_states(self):
-        ''' equivalent to a salt cli: salt web state.show_top'''
+        '''
+        equivalent to a salt cli: salt web state.show_top
+        returns the sls names in the top, e.g. apache.vhost_web1, see group_top_states
+        '''
         try:
             returned = self.call_salt_command(fun='state.show_top',
                                               args=None,
                                               kwargs=None)
-            # doing this to handle states with periods
-            # e.g.  apache.vhost_web1
-            alt_states = []
+            top_states = []
             for state in returned['base']:
-                state_bits = state.split(".")
-                state_name = state_bits[0]
-                if state_name not in alt_states:
-                    alt_states.append(state_name)
+                state = StateTestLoader.normalize_sls(state)
+                if state not in top_states:
+                    top_states.append(state)
         except Exception:
             raise
-        log.info("top states: {}".format(alt_states))
-        #return returned['base']
-        return alt_states
+        log.info("top states: {}".format(top_states))
+        return top_states
+
+    @staticmethod
+    def group_top_states(sls_names):
+        '''
+        group sls names by the state (the directory holding salt-check-tests) they belong to,
+        in top order; e.g. ['apache.vhost_web1', 'mysql'] gives
+        [('apache', ['apache.vhost_web1']), ('mysql', ['mysql'])]
+        '''
+        groups = collections.OrderedDict()
+        for sls_name in sls_names:
+            # doing this to handle states with periods
+            # e.g.  apache.vhost_web1
+            groups.setdefault(sls_name.split(".")[0], []).append(sls_name)
+        return list(groups.items())
 
     def populate_salt_modules_list(self):
         '''return a list of all modules available on minion'''
@@ -142,12 +516,19 @@ class SaltCheck(object):
 
     def is_valid_function(self, module_name, function):
         '''Determine if a function is valid for a module'''
-        try:
-            functions = self.call_salt_command(fun='sys.list_functions',
-                                               args=[module_name],
-                                               kwargs=None)
-        except salt.exceptions.SaltException:
-            functions = ["unable to look up functions"]
+        import salt.exceptions
+        functions = self.functions.get(module_name, None)
+        if functions is None:
+            try:
+                functions = self.call_salt_command(fun='sys.list_functions',
+                                                   args=[module_name],
+                                                   kwargs=None)
+            except salt.exceptions.SaltException:
+                functions = ["unable to look up functions"]
+            if isinstance(functions, list):
+                self.functions[module_name] = set(functions)
+            else:
+                functions = []
         return "{0}.{1}".format(module_name, function) in functions
 
     def is_valid_test(self, test_dict):
@@ -181,6 +562,7 @@ class SaltCheck(object):
                           args=None,
                           kwargs=None):
         '''Generic call of salt Caller command'''
+        import salt.exceptions
         value = False
         try:
             if args and kwargs:
@@ -202,6 +584,7 @@ class SaltCheck(object):
                                fun
                                ):
         '''Generic call of salt Caller command'''
+        import salt.exceptions
         value = False
         try:
             value = self.salt_lc.function(fun)
@@ -211,57 +594,83 @@ class SaltCheck(object):
 
     def run_test(self, test_dict):
         '''Run a single salt_check test'''
-        if self.is_valid_test(test_dict):
-            mod_and_func = test_dict['module_and_function']
-            args = test_dict.get('args', None)
-            assertion = test_dict['assertion']
-            expected_return = test_dict['expected-return']
-            kwargs = test_dict.get('kwargs', None)
-            actual_return = self.call_salt_command(mod_and_func, args, kwargs)
-            #log.info("expected before alteration= {}".format(expected_return))
-            #log.info("type of expected before= {}".format(type(expected_return)))
-            expected_return = self.cast_expected_to_returned_type(expected_return, actual_return)
-            #log.info("expected after alteration= {}".format(expected_return))
-            #log.info("type of expected = {}".format(type(expected_return)))
-            # return actual_return
-            if assertion == "assertEqual":
-                value = self.assert_equal(expected_return, actual_return)
-            elif assertion == "assertNotEqual":
-                value = self.assert_not_equal(expected_return, actual_return)
-            elif assertion == "assertTrue":
-                value = self.assert_true(expected_return)
-            elif assertion == "assertFalse":
-                value = self.assert_false(expected_return)
-            elif assertion == "assertIn":
-                value = self.assert_in(expected_return, actual_return)
-            elif assertion == "assertNotIn":
-                value = self.assert_not_in(expected_return, actual_return)
-            elif assertion == "assertGreater":
-                value = self.assert_greater(expected_return, actual_return)
-            elif assertion == "assertGreaterEqual":
-                value = self.assert_greater_equal(expected_return, actual_return)
-            elif assertion == "assertLess":
-                value = self.assert_less(expected_return, actual_return)
-            elif assertion == "assertLessEqual":
-                value = self.assert_less_equal(expected_return, actual_return)
-            else:
-                value = False
+        compiled = self.compile_test(None, test_dict)
+        try:
+            eventually = self.eventually_options(test_dict.get('eventually', None))
+        except ValueError as err:
+            return "False: Invalid test: {}".format(err)
+        if compiled.valid and eventually:
+            value = self.check_eventually(compiled, eventually)[0]
+        elif compiled.valid:
+            value = self.check_return(compiled, self.spill(compiled.call()))
         else:
             value = "False: Invalid test"
         return value
 
+    def compile_test(self, test_name, test_dict):
+        '''
+        Validate a test and resolve everything about it that does not depend
+        on what the salt function returns, see CompiledTest
+        '''
+        if not self.is_valid_test(test_dict):
+            return CompiledTest.invalid(test_name, test_dict)
+        mod_and_func = test_dict['module_and_function']
+        args = test_dict.get('args', None) or []
+        kwargs = test_dict.get('kwargs', None) or {}
+        pillar_data = test_dict.get('pillar-data', None)
+        if pillar_data and PillarCache.can_answer(mod_and_func, args, kwargs):
+            func = functools.partial(self.pillar_cache.call, mod_and_func, pillar_data)
+        else:
+            if pillar_data:
+                kwargs = dict(kwargs, pillar=pillar_data)
+            try:
+                func, args, kwargs = self.resolve_function(mod_and_func, args, kwargs)
+            except Exception as err:
+                log.info("Unable to resolve {0}: {1}".format(mod_and_func, err))
+                func, args, kwargs = functools.partial(self.call_salt_command, mod_and_func), (args, kwargs), {}
+        method, takes_returned = self.ASSERTIONS[test_dict['assertion']]
+        expected = test_dict['expected-return']
+        return CompiledTest(test_name, test_dict, True, func, tuple(args), kwargs,
+                            getattr(self, method), takes_returned, expected,
+                            self.cast_expected_to_return_types(expected))
+
+    def resolve_function(self, fun, args, kwargs):
+        '''return a callable, args and kwargs that call a salt function like call_salt_command'''
+        resolve = getattr(self.salt_lc, 'resolve', None)
+        if resolve is not None:
+            return resolve(fun, args, kwargs)
+        return functools.partial(self.salt_lc.function, fun), args, kwargs
+
+    @staticmethod
+    def cast_expected(expected, ret_type):
+        '''Cast the expected return to a type, raises if it cannot be'''
+        if expected == "False" and ret_type == bool:
+            expected = False
+        return ret_type(expected)
+
+    @classmethod
+    def cast_expected_to_return_types(cls, expected):
+        '''
+        (type, expected cast to it) for each of RETURN_TYPES, the expected
+        return itself where it cannot be cast
+        '''
+        casts = []
+        for ret_type in cls.RETURN_TYPES:
+            try:
+                casts.append((ret_type, cls.cast_expected(expected, ret_type)))
+            except Exception:
+                casts.append((ret_type, expected))
+        return tuple(casts)
+
     @staticmethod
     def cast_expected_to_returned_type(expected, returned):
         '''
         Determine the type of variable returned
         Cast the expected to the type of variable returned
         '''
-        ret_type = type(returned)
         new_expected = expected
-        if expected == "False" and ret_type == bool:
-            expected = False
         try:
-            new_expected = ret_type(expected)
+            new_expected = SaltCheck.cast_expected(expected, type(returned))
         except:
             log.info("Unable to cast expected into type of returned")
             log.info("returned = {}".format(returned))
@@ -315,14 +724,23 @@ class SaltCheck(object):
             result = "False: " + str(err)
         return result
 
+    @staticmethod
+    def literal(value):
+        '''Read a string holding a python literal ("False", "0", "[1, 2]"), else leave it'''
+        import ast
+        try:
+            return ast.literal_eval(value.strip())
+        except (ValueError, SyntaxError):
+            return value
+
     @staticmethod
     def assert_false(returned):
         '''
         Test if an boolean is False
         '''
         result = (True)
-        if type(returned) == str:
-            returned = eval(returned)
+        if isinstance(returned, string_types):
+            returned = SaltCheck.literal(returned)
         try:
             assert (returned is False), "{0} not False".format(returned)
         except AssertionError as err:
@@ -434,48 +852,370 @@ class SaltCheck(object):
         paths = self.get_state_search_path_list()
         return paths
 
+    def spill(self, returned):
+        '''
+        a SpilledReturn in place of a string return longer than the salt_check_spill_size
+        minion option (default 1MiB of characters, 0 turns spilling off)
+        Pass the return straight from the call, so no other reference keeps the
+        in-memory copy alive once it is written out
+        '''
+        limit = self.opts.get('salt_check_spill_size', SpilledReturn.DEFAULT_SIZE)
+        if limit and isinstance(returned, string_types) and len(returned) > limit:
+            return SpilledReturn(returned, os.path.join(self.get_salt_check_cachedir(), 'spill'))
+        return returned
+
+    @classmethod
+    def eventually_options(cls, value):
+        '''
+        the polling options of a test's "eventually": True, a timeout in seconds,
+        or a dictionary overriding EVENTUALLY; None if the test is not polled
+        Raises ValueError for options that are not numbers, not more than 0, or for a
+        backoff below 1, which would poll without waiting
+        '''
+        if not value:
+            return None
+        options = dict(cls.EVENTUALLY)
+        wrong_type = "eventually must be True, a number of seconds or a dictionary"
+        if isinstance(value, dict):
+            wrong_type = "eventually must map {} to numbers".format(", ".join(sorted(cls.EVENTUALLY)))
+            if not all(key in cls.EVENTUALLY for key in value):
+                raise ValueError(wrong_type)
+            options.update(value)
+        elif value is not True:
+            options['timeout'] = value
+        for key in sorted(options):
+            option = options[key]
+            if isinstance(option, bool) or not isinstance(option, (int, float)):
+                raise ValueError(wrong_type)
+            if option <= 0:
+                raise ValueError("eventually {} must be more than 0".format(key))
+        if options['backoff'] < 1:
+            raise ValueError("eventually backoff must be at least 1")
+        return options
+
+    def check_eventually(self, compiled, options):
+        '''
+        Call and check a test until it passes or the timeout expires, waiting interval
+        seconds after the first attempt, backoff times longer after each (at most max_interval)
+        Returns (result, attempts, seconds until it passed or None)
+        '''
+        start = time.time()
+        delay = float(options['interval'])
+        attempts = 0
+        while True:
+            attempts += 1
+            result = self.check_return(compiled, self.spill(compiled.call()))
+            elapsed = time.time() - start
+            if result is True:
+                return result, attempts, round(elapsed, 3)
+            remaining = float(options['timeout']) - elapsed
+            if remaining <= 0:
+                return result, attempts, None
+            time.sleep(min(delay, remaining))
+            delay = min(delay * float(options['backoff']), float(options['max_interval']))
+
+    @staticmethod
+    def check_return(compiled, returned):
+        '''Check a return, removing it from disk afterwards if it was spilled'''
+        try:
+            return compiled.check(returned)
+        finally:
+            if isinstance(returned, SpilledReturn):
+                returned.discard()
+
+    def get_salt_check_cachedir(self):
+        '''return the dir salt_check keeps its own files in (under the minion cachedir)'''
+        return os.path.join(self.opts['cachedir'], 'salt_check')
+
 
 class StateTestLoader(object):
     '''
     Class loads in test files for a state
     e.g.  state_dir/salt-check-tests/[1.tst, 2.tst, 3.tst]
+    Tests in a sub-directory belong to one sls of the state, e.g. the tests in
+    apache/salt-check-tests/vhost_web1/ to apache.vhost_web1, and a test can name
+    its sls with an sls key; other tests belong to the state as a whole
     '''
 
-    def __init__(self, search_paths):
+    def __init__(self, search_paths, renderer=None):
         self.search_paths = search_paths
+        self.renderer = renderer  # a SuiteRenderer, for yaml test files written as templates
         self.path_type = None
         self.test_files = []  # list of file paths
+        self.state_name = None
+        self.file_sls = {}  # test file path -> the sls of its sub-directory, None at the top
         self.test_dict = {}
+        self.test_sources = {}  # test name -> file path it was loaded from
+        self.duplicates = []  # [test name, first file, duplicate file]
+        self.errors = {}  # test name -> list of schema problems
+        self.rendered = {}  # template path -> rendered text, see render_templates
 
     def load_test_suite(self):
         '''load tests either from one file, or a set of files'''
-        for myfile in self.test_files:
-            self.load_file(myfile)
+        for key, value in self.iter_tests():
+            self.test_dict[key] = value
 
     def load_file(self, filepath):
         '''
         loads in one test file
         '''
-        try:
-            myfile = open(filepath, 'r')
-            contents_yaml = yaml.load(myfile)
-            for key, value in contents_yaml.items():
-                self.test_dict[key] = value
-        except:
-            raise
+        for key, value in self.iter_file(filepath):
+            self.test_dict[key] = value
         return
 
+    def iter_tests(self, suite_filter=None, index=None, sls_names=None):
+        '''
+        Lazily yield (test name, test) for every test file, one file at a time
+        A test name already seen in an earlier file is reported and skipped
+        With a SuiteFilter only picked tests are yielded, and with a SuiteIndex
+        files known to hold no picked test are not read at all
+        With sls_names only the tests of those sls (and of the state as a whole)
+        are yielded, sub-directories of other sls are not read
+        '''
+        if suite_filter is not None and not suite_filter.is_active():
+            suite_filter = None
+        if sls_names is not None:
+            sls_names = set(self.normalize_sls(name) for name in sls_names)
+        for myfile in self.test_files:
+            if self.is_other_sls(myfile, sls_names):
+                log.debug("Skipping {0}, {1} is not applied".format(myfile, self.file_sls[myfile]))
+                continue
+            if suite_filter and index is not None:
+                file_tests = index.get(myfile)
+                if file_tests is not None and not suite_filter.matches_any(file_tests):
+                    log.debug("Skipping {}, no test in it is picked".format(myfile))
+                    continue
+            if index is not None:
+                size, mtime = index.file_stamp(myfile)
+            file_tests = {}
+            for key, value in self.iter_file(myfile, file_tests):
+                if suite_filter is not None and not suite_filter.matches(key, file_tests[key]):
+                    continue
+                if sls_names is None or self.sls_matches(myfile, value, sls_names):
+                    yield key, value
+            # the tests of a template depend on grains and pillar, not only on the file
+            if index is not None and (self.renderer is None or myfile not in self.renderer.templates):
+                index.update(myfile, size, mtime, file_tests)
+
+    def render_templates(self, sls_names=None):
+        '''
+        Render the yaml test files that are templates now, on the calling thread:
+        read_yaml then only reads files, and iter_tests calls no salt function
+        '''
+        if self.renderer is None:
+            return
+        if sls_names is not None:
+            sls_names = set(self.normalize_sls(name) for name in sls_names)
+        for myfile in self.test_files:
+            if self.is_other_sls(myfile, sls_names):
+                continue
+            if TEST_FILE_FORMATS.get(os.path.splitext(myfile)[1], 'yaml') != 'yaml':
+                continue
+            with open(myfile, 'r') as handle:
+                is_template = SuiteRenderer.is_template(handle.readline())
+            if is_template:
+                self.rendered[myfile] = self.read_yaml(myfile)
+
+    def is_other_sls(self, filepath, sls_names):
+        '''True if a test file is in the sub-directory of an sls not in sls_names'''
+        file_sls = self.file_sls.get(filepath, None)
+        return sls_names is not None and file_sls is not None and file_sls not in sls_names
+
+    @staticmethod
+    def normalize_sls(name):
+        '''apache.init is the same sls as apache'''
+        name = str(name).strip()
+        if name.endswith('.init'):
+            name = name[:-len('.init')]
+        return name
+
+    def get_test_sls(self, filepath, test):
+        '''
+        the sls names a test belongs to, from its sls key or else its directory,
+        None if it belongs to the state as a whole
+        '''
+        names = []
+        if isinstance(test, dict):
+            names = SuiteFilter.split_option(test.get('sls', None))
+        if not names:
+            file_sls = self.file_sls.get(filepath, None)
+            return None if file_sls is None else [file_sls]
+        state_name = self.state_name
+        full_names = []
+        for name in names:
+            name = self.normalize_sls(name)
+            if state_name and name != state_name and not name.startswith(state_name + '.'):
+                # a name relative to the state, e.g. vhost_web1 for apache.vhost_web1
+                name = "{0}.{1}".format(state_name, name)
+            full_names.append(name)
+        return full_names
+
+    def sls_matches(self, filepath, test, sls_names):
+        '''True if a test belongs to the state as a whole or to any of the sls names'''
+        test_sls = self.get_test_sls(filepath, test)
+        return test_sls is None or bool(sls_names.intersection(test_sls))
+
+    @staticmethod
+    def get_test_tags(test):
+        '''return the tags of a test as a list'''
+        if not isinstance(test, dict):
+            return []
+        return SuiteFilter.split_option(test.get('tags', None))
+
+    def iter_file(self, filepath, file_tests=None):
+        '''
+        Lazily yield (test name, test) from one test file, document by document
+        The file format is picked by the file extension, see TEST_FILE_FORMATS
+        file_tests, if given, is filled with test name -> tags for every test of the
+        file, duplicates included, as a SuiteIndex entry for the file
+        '''
+        file_format = TEST_FILE_FORMATS.get(os.path.splitext(filepath)[1], 'yaml')
+        for contents in getattr(self, 'iter_{}_documents'.format(file_format))(filepath):
+            if contents is None:
+                continue
+            if not isinstance(contents, dict):
+                log.warning("Skipping a document in {}, it is not a set of tests".format(filepath))
+                continue
+            for key, value in contents.items():
+                if file_tests is not None:
+                    file_tests[key] = self.get_test_tags(value)
+                if self.is_duplicate(key, filepath):
+                    continue
+                problems = self.check_test_schema(value)
+                if problems:
+                    self.errors[key] = problems
+                    log.warning("Invalid test {0} in {1}: {2}".format(key, filepath, "; ".join(problems)))
+                yield key, value
+
+    def read_yaml(self, filepath):
+        '''the text of a yaml test file, rendered first if it is a template'''
+        if filepath in self.rendered:
+            return self.rendered[filepath]
+        with open(filepath, 'r') as myfile:
+            contents = myfile.read()
+        if self.renderer is not None and SuiteRenderer.is_template(contents):
+            contents = self.renderer.render(filepath, contents)
+        return contents
+
+    def iter_yaml_documents(self, filepath):
+        '''yield each document of a (multi-document) yaml file'''
+        for contents in yaml.load_all(self.read_yaml(filepath), Loader=YamlSafeLoader):
+            yield contents
+
+    def iter_yaml_documents_with_lines(self, filepath):
+        '''
+        yield (document, {test name: line number}) for each document of a yaml file
+        line numbers of a template are those of its rendered text
+        '''
+        loader = YamlSafeLoader(self.read_yaml(filepath))
+        try:
+            while loader.check_node():
+                node = loader.get_node()
+                lines = {}
+                if isinstance(node, yaml.MappingNode):
+                    for key_node, value_node in node.value:
+                        lines[key_node.value] = key_node.start_mark.line + 1
+                yield loader.construct_document(node), lines
+        finally:
+            loader.dispose()
+
+    @staticmethod
+    def iter_json_documents(filepath):
+        '''yield the tests of a json file, either one object or a list of objects'''
+        with open(filepath, 'r') as myfile:
+            contents = json_loads(myfile.read())
+        if isinstance(contents, list):
+            for document in contents:
+                yield document
+        else:
+            yield contents
+
+    @staticmethod
+    def iter_msgpack_documents(filepath):
+        '''yield each object of a msgpack file, one object per set of tests'''
+        if not HAS_MSGPACK:
+            log.error("Unable to load {}, the msgpack python library is not installed".format(filepath))
+            return
+        with open(filepath, 'rb') as myfile:
+            try:
+                unpacker = msgpack.Unpacker(myfile, raw=False)
+            except TypeError:
+                # msgpack < 0.5.2
+                unpacker = msgpack.Unpacker(myfile, encoding='utf-8')
+            for contents in unpacker:
+                yield contents
+
+    @staticmethod
+    def check_test_schema(test):
+        '''
+        Check the layout of one test, the same for every file format
+        Returns a list of problems, empty if there are none
+        '''
+        if not isinstance(test, dict):
+            return ["test must be a dictionary"]
+        problems = []
+        m_and_f = test.get('module_and_function', None)
+        if not isinstance(m_and_f, string_types) or len(m_and_f.split('.')) != 2:
+            problems.append("module_and_function must be MODULE.FUNCTION")
+        if not isinstance(test.get('assertion', None), string_types):
+            problems.append("assertion is required")
+        if 'expected-return' not in test:
+            problems.append("expected-return is required")
+        if not isinstance(test.get('args', None), (list, type(None)) + string_types):
+            problems.append("args must be a list")
+        if not isinstance(test.get('kwargs', None), (dict, type(None))):
+            problems.append("kwargs must be a dictionary")
+        if not isinstance(test.get('pillar-data', None), (dict, type(None))):
+            problems.append("pillar-data must be a dictionary")
+        for key in ('only_if_grains', 'unless_grains'):
+            if not isinstance(test.get(key, None), (dict, type(None))):
+                problems.append("{} must map grains to values".format(key))
+        if not isinstance(test.get('sls', None), (list, type(None)) + string_types):
+            problems.append("sls must be an sls name or a list")
+        if not isinstance(test.get('tags', None), (list, type(None)) + string_types):
+            problems.append("tags must be a list")
+        if not isinstance(test.get('cache_ttl', None), (int, float, type(None))):
+            problems.append("cache_ttl must be a number of seconds")
+        if not isinstance(test.get('duration', None), (int, float, type(None))):
+            problems.append("duration must be a number of seconds")
+        if not isinstance(test.get('resource_class', None), string_types + (type(None),)):
+            problems.append("resource_class must be a name")
+        try:
+            SaltCheck.eventually_options(test.get('eventually', None))
+        except ValueError as err:
+            problems.append(str(err))
+        return problems
+
+    def is_duplicate(self, test_name, filepath):
+        '''Record where a test came from, report it if the name was already used'''
+        first_file = self.test_sources.get(test_name, None)
+        if first_file is None:
+            self.test_sources[test_name] = filepath
+            return False
+        self.duplicates.append([test_name, first_file, filepath])
+        log.warning("Duplicate test name {0} in {1}, already defined in {2}".format(
+            test_name, filepath, first_file))
+        return True
+
     def gather_files(self, filepath):
         '''gather files for a test suite'''
         log.info("gather_files: {}".format(time.time()))
+        self.state_name = os.path.basename(filepath.rstrip(os.sep))
         filepath = filepath + os.sep + 'salt-check-tests'
         rootDir = filepath
         for dirName, subdirList, fileList in os.walk(rootDir):
-            for fname in fileList:
-                if fname.endswith('.tst'):
+            # walk in a fixed order, so tests always load (and run) in the same order
+            subdirList.sort()
+            subdir = os.path.relpath(dirName, rootDir)
+            file_sls = None
+            if subdir != os.curdir:
+                file_sls = "{0}.{1}".format(self.state_name, subdir.replace(os.sep, '.'))
+            for fname in sorted(fileList):
+                if os.path.splitext(fname)[1] in TEST_FILE_FORMATS:
                     start_path = dirName + os.sep + fname
                     full_path = os.path.abspath(start_path)
                     self.test_files.append(full_path)
+                    self.file_sls[full_path] = file_sls
         return
 
     def find_state_dir(self, state_name):
@@ -495,6 +1235,511 @@ class StateTestLoader(object):
         return state_path
 
 
+class SuiteSharder(object):
+    '''
+    Deterministically splits tests across n shards
+    e.g.  shard=2/4 runs the second of four parts of a suite
+    Every shard must be given the same weights (or none) to get disjoint parts
+    '''
+
+    def __init__(self, shard, weights=None):
+        self.index, self.count = self.parse_shard(shard)
+        self.weights = weights or {}
+        self.loads = [0.0] * self.count
+        all_weights = [weight for state_weights in self.weights.values()
+                       for weight in state_weights.values()]
+        if all_weights:
+            self.default_weight = sum(all_weights) / len(all_weights)
+        else:
+            self.default_weight = 1.0
+
+    @staticmethod
+    def parse_shard(shard):
+        '''turn "i/n" into (i, n), shards are numbered 1 to n'''
+        try:
+            index, count = [int(bit) for bit in str(shard).split('/')]
+        except ValueError:
+            raise ValueError("shard must be in the form i/n, e.g. 2/4")
+        if count < 1 or index < 1 or index > count:
+            raise ValueError("shard must be in the form i/n, with 1 <= i <= n")
+        return index, count
+
+    @staticmethod
+    def stable_hash(state_name, test_name):
+        '''hash of state and test name that is the same on every host and run'''
+        key = u"{0}:{1}".format(state_name, test_name).encode('utf-8')
+        return int(hashlib.md5(key).hexdigest(), 16)
+
+    def select(self, state_name, tests):
+        '''yield the (test name, test) pairs of tests belonging to this shard'''
+        if self.weights:
+            for pair in self.select_weighted(state_name, tests):
+                yield pair
+            return
+        for test_name, test in tests:
+            if self.stable_hash(state_name, test_name) % self.count == self.index - 1:
+                yield test_name, test
+
+    def select_weighted(self, state_name, tests):
+        '''
+        Longest test first, each to the least loaded shard so far
+        Needs all tests of the state up front, and loads carry over between calls,
+        so states must be selected in the same order on every shard
+        '''
+        state_weights = self.weights.get(state_name, {})
+
+        def weight(test_name):
+            return state_weights.get(test_name, self.default_weight)
+
+        ordered = sorted(tests,
+                         key=lambda pair: (-weight(pair[0]), self.stable_hash(state_name, pair[0])))
+        selected = []
+        for test_name, test in ordered:
+            shard = self.loads.index(min(self.loads))
+            self.loads[shard] += weight(test_name)
+            if shard == self.index - 1:
+                selected.append((test_name, test))
+        return selected
+
+
+def _load_json_file(path):
+    '''load a json file holding a dictionary, an unreadable file counts as empty'''
+    try:
+        with open(path, 'r') as myfile:
+            contents = json.load(myfile)
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(contents, dict):
+        return {}
+    return contents
+
+
+def _save_json_file(path, contents):
+    '''
+    write a json file, replacing the old one in a single rename
+    The file is readable by its owner only: rendered tests and cached returns may
+    hold pillar secrets
+    '''
+    dirname = os.path.dirname(path)
+    try:
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            # left over by an interrupted save, maybe with other permissions
+            os.remove(tmp_path)
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as myfile:
+            json.dump(contents, myfile)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as err:
+        log.warning("Unable to save {0}: {1}".format(path, err))
+
+
+class SuiteDurations(object):
+    '''
+    Recorded run time in seconds of each test, kept as json in the salt_check cachedir
+    e.g.  {"apache": {"apache-conf-exists": 0.0123}}
+    '''
+
+    def __init__(self, cachedir):
+        self.path = os.path.join(cachedir, 'durations.json')
+        self.durations = _load_json_file(self.path)
+
+    def get(self, state_name, test_name, default=None):
+        '''return the recorded duration of a test'''
+        return self.durations.get(state_name, {}).get(test_name, default)
+
+    def record(self, state_name, test_name, seconds):
+        '''record a duration, smoothed with the previous one to damp one-off slow runs'''
+        previous = self.get(state_name, test_name)
+        if previous is not None:
+            seconds = (previous + seconds) / 2.0
+        self.durations.setdefault(state_name, {})[test_name] = round(seconds, 4)
+
+    def save(self):
+        '''write the durations file'''
+        _save_json_file(self.path, self.durations)
+
+
+class SuiteFailures(object):
+    '''
+    Tests that failed on their last run, kept as json in the salt_check cachedir
+    e.g.  {"apache": ["apache-conf-exists"]}
+    '''
+
+    def __init__(self, cachedir):
+        self.path = os.path.join(cachedir, 'last_failed.json')
+        self.failed = dict((state_name, set(names))
+                           for state_name, names in _load_json_file(self.path).items())
+
+    def is_failed(self, state_name, test_name):
+        '''True if the test failed on its last run'''
+        return test_name in self.failed.get(state_name, ())
+
+    def record(self, state_name, test_name, result):
+        '''remember whether a test failed'''
+        if result is True:
+            self.failed.get(state_name, set()).discard(test_name)
+        else:
+            self.failed.setdefault(state_name, set()).add(test_name)
+
+    def save(self):
+        '''write the failures file'''
+        _save_json_file(self.path, dict((state_name, sorted(names))
+                                        for state_name, names in self.failed.items() if names))
+
+
+class SuiteFilter(object):
+    '''
+    Picks tests by name and tag
+    include / exclude are lists of glob patterns matched against test names,
+    tags is a list of tags, a test needs at least one of them to be picked
+    '''
+
+    def __init__(self, include=None, exclude=None, tags=None):
+        self.include = self.split_option(include)
+        self.exclude = self.split_option(exclude)
+        self.tags = set(self.split_option(tags))
+
+    @staticmethod
+    def split_option(value):
+        '''accept a list or a comma separated string from the cli'''
+        if not value:
+            return []
+        if isinstance(value, string_types):
+            value = value.split(',')
+        return [str(item).strip() for item in value if str(item).strip()]
+
+    def is_active(self):
+        '''True if the filter can leave out any test'''
+        return bool(self.include or self.exclude or self.tags)
+
+    def matches(self, test_name, test_tags):
+        '''True if a test with this name and tags is picked'''
+        if self.include and not any(fnmatch.fnmatchcase(test_name, pat) for pat in self.include):
+            return False
+        if any(fnmatch.fnmatchcase(test_name, pat) for pat in self.exclude):
+            return False
+        if self.tags and not self.tags.intersection(test_tags):
+            return False
+        return True
+
+    def matches_any(self, file_tests):
+        '''True if any test of an index entry (test name -> tags) is picked'''
+        for test_name, test_tags in file_tests.items():
+            if self.matches(test_name, test_tags):
+                return True
+        return False
+
+
+class GrainSelector(object):
+    '''
+    Picks tests by the grains of the minion, from a snapshot taken once per run
+    only_if_grains: {GRAIN: VALUE} runs a test only if every grain matches,
+    unless_grains: {GRAIN: VALUE} skips it if every grain matches
+    A VALUE may be a glob or a list of globs (any of), matched without case like
+    grain targeting; nested grains are written GRAIN:KEY
+    '''
+
+    def __init__(self, grains):
+        self.grains = grains if isinstance(grains, dict) else {}
+
+    @staticmethod
+    def is_selective(test):
+        '''True if a test has a grains condition'''
+        return isinstance(test, dict) and bool(test.get('only_if_grains') or test.get('unless_grains'))
+
+    def grain_matches(self, grain, patterns):
+        '''True if the grain, or any item of a list grain, matches any of the patterns'''
+        value = PillarCache.traverse(self.grains, grain, None)
+        if value is None:
+            return False
+        values = value if isinstance(value, list) else [value]
+        if not isinstance(patterns, list):
+            patterns = [patterns]
+        return any(fnmatch.fnmatchcase(str(item).lower(), str(pattern).lower())
+                   for item in values for pattern in patterns)
+
+    @staticmethod
+    def describe(patterns):
+        '''patterns as text for a skip reason, e.g. CentOS|Rocky'''
+        if isinstance(patterns, list):
+            return "|".join(str(pattern) for pattern in patterns)
+        return str(patterns)
+
+    def skip_reason(self, test):
+        '''why a test is skipped on this minion, None if it runs'''
+        for grain, patterns in sorted((test.get('only_if_grains') or {}).items()):
+            if not self.grain_matches(grain, patterns):
+                return "Skipped: grain {0} is {1}, not {2}".format(
+                    grain, PillarCache.traverse(self.grains, grain, None), self.describe(patterns))
+        unless = test.get('unless_grains') or {}
+        if unless and all(self.grain_matches(grain, patterns) for grain, patterns in unless.items()):
+            return "Skipped: grains match unless_grains {}".format(
+                ", ".join("{0}={1}".format(grain, self.describe(patterns)) for grain, patterns in sorted(unless.items())))
+        return None
+
+    def select(self, tests, errors, skipped):
+        '''
+        yield the (test name, test) pairs that run on this minion, and put
+        (test name, reason) in skipped for the others
+        '''
+        for test_name, test in tests:
+            if test_name not in errors and self.is_selective(test):
+                reason = self.skip_reason(test)
+                if reason:
+                    skipped.append((test_name, reason))
+                    continue
+            yield test_name, test
+
+
+class SuiteIndex(object):
+    '''
+    Test names and tags of every test file seen, kept as json in the salt_check cachedir
+    An entry is only used while the file size and mtime are unchanged
+    e.g.  {"/path/to/1.tst": {"size": 123, "mtime": 1462060800.0, "tests": {"test-1": ["smoke"]}}}
+    '''
+
+    def __init__(self, cachedir):
+        self.path = os.path.join(cachedir, 'index.json')
+        self.entries = _load_json_file(self.path)
+        self.changed = False
+
+    @staticmethod
+    def file_stamp(filepath):
+        '''return (size, mtime) of a file'''
+        stat = os.stat(filepath)
+        return stat.st_size, stat.st_mtime
+
+    def get(self, filepath):
+        '''return the tests (test name -> tags) of an unchanged file, or None'''
+        entry = self.entries.get(filepath, None)
+        if not entry:
+            return None
+        try:
+            size, mtime = self.file_stamp(filepath)
+        except OSError:
+            return None
+        if entry.get('size') != size or entry.get('mtime') != mtime:
+            return None
+        return entry.get('tests', {})
+
+    def update(self, filepath, size, mtime, file_tests):
+        '''record the tests (test name -> tags) of a file read when it had this size and mtime'''
+        self.entries[filepath] = {'size': size, 'mtime': mtime, 'tests': file_tests}
+        self.changed = True
+
+    def save(self):
+        '''write the index file if anything was added'''
+        if self.changed:
+            _save_json_file(self.path, self.entries)
+            self.changed = False
+
+
+class ResultCache(object):
+    '''
+    Returns of cacheable tests, kept as json in the salt_check cachedir
+    A test is cacheable with "cacheable: True" (ttl from the salt_check_cache_ttl
+    minion option) or "cache_ttl: SECONDS". salt_check_cache_ttl maps a module,
+    or module.function, to a ttl in seconds, with an optional 'default' key e.g.
+      salt_check_cache_ttl:
+        default: 300
+        pkg: 3600
+    A cached return is dropped once a state run (state.sls / state.highstate)
+    newer than it touched the state the test belongs to
+    Only returns that json gives back unchanged are cached (not tuples, nor
+    dictionaries with keys other than strings), a hit compares like the return
+    '''
+    DEFAULT_TTL = 300
+    STATE_RUN_FILES = ['sls.p', 'highstate.cache.p']
+
+    def __init__(self, cachedir, opts):
+        self.path = os.path.join(cachedir, 'result_cache.json')
+        self.entries = _load_json_file(self.path)
+        self.ttls = opts.get('salt_check_cache_ttl', None) or {}
+        self.state_runs = self.get_state_runs(opts['cachedir'])
+        self.changed = False
+        self.hits = 0
+        # get and put are called from the SuiteScheduler workers
+        self.lock = threading.Lock()
+
+    def get_state_runs(self, minion_cachedir):
+        '''
+        return [mtime, sls names touched] of the last state runs, the sls names
+        are None when they cannot be read (meaning every state may have changed)
+        '''
+        state_runs = []
+        for fname in self.STATE_RUN_FILES:
+            path = os.path.join(minion_cachedir, fname)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            state_runs.append([mtime, self.read_touched_sls(path)])
+        return state_runs
+
+    @staticmethod
+    def read_touched_sls(path):
+        '''return the set of sls names in a saved state run return, or None'''
+        if not HAS_MSGPACK:
+            return None
+        try:
+            with open(path, 'rb') as myfile:
+                ret = msgpack.unpack(myfile, raw=False)
+        except Exception:
+            return None
+        if not isinstance(ret, dict):
+            return None
+        touched = set()
+        for state_ret in ret.values():
+            if isinstance(state_ret, dict) and state_ret.get('__sls__'):
+                touched.add(state_ret['__sls__'])
+        return touched
+
+    def get_ttl(self, test_dict):
+        '''return the ttl of a test in seconds, 0 if it is not cacheable'''
+        if test_dict.get('cache_ttl', None) is not None:
+            return float(test_dict['cache_ttl'])
+        if not test_dict.get('cacheable', False):
+            return 0
+        mod_and_func = test_dict['module_and_function']
+        for key in (mod_and_func, mod_and_func.split('.')[0], 'default'):
+            if key in self.ttls:
+                return float(self.ttls[key])
+        return self.DEFAULT_TTL
+
+    @staticmethod
+    def make_key(test_dict):
+        '''the same salt function, args and kwargs share a cached return'''
+        call = [test_dict['module_and_function'],
+                test_dict.get('args', None),
+                test_dict.get('kwargs', None)]
+        if test_dict.get('pillar-data', None):
+            call.append(test_dict['pillar-data'])
+        return hashlib.md5(json.dumps(call, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def is_stale(self, state_name, entry):
+        '''True if a state run after the entry was cached touched its state'''
+        for mtime, touched in self.state_runs:
+            if mtime <= entry['time']:
+                continue
+            if touched is None:
+                return True
+            for sls in touched:
+                if sls == state_name or sls.startswith(state_name + '.'):
+                    return True
+        return False
+
+    def get(self, state_name, test_dict, ttl):
+        '''return (True, cached return) on a hit, (False, None) on a miss'''
+        entry = self.entries.get(self.make_key(test_dict), None)
+        if entry is None or time.time() - entry['time'] > ttl:
+            return False, None
+        if self.is_stale(state_name, entry):
+            return False, None
+        with self.lock:
+            self.hits += 1
+        return True, entry['return']
+
+    def put(self, state_name, test_dict, ttl, returned):
+        '''cache a return, unless it is an error or json does not give it back unchanged'''
+        if isinstance(returned, Exception):
+            return
+        try:
+            loaded = json.loads(json.dumps(returned))
+        except (TypeError, ValueError):
+            return
+        if loaded != returned:
+            return
+        with self.lock:
+            self.entries[self.make_key(test_dict)] = {'time': time.time(),
+                                                      'expires': time.time() + ttl,
+                                                      'state': state_name,
+                                                      'return': loaded}
+            self.changed = True
+
+    def clear(self):
+        '''drop every cached return'''
+        self.entries = {}
+        self.changed = True
+
+    def save(self):
+        '''write the cache file, leaving out expired entries'''
+        if not self.changed:
+            return
+        now = time.time()
+        self.entries = dict((key, entry) for key, entry in self.entries.items()
+                            if entry.get('expires', 0) > now)
+        _save_json_file(self.path, self.entries)
+        self.changed = False
+
+
+class SuiteRenderer(object):
+    '''
+    Renders yaml test files written as jinja templates through the salt renderer
+    (file.apply_template_on_contents), with the grains and pillar of the minion
+    Only files whose first line is a renderer line naming jinja (#!jinja|yaml) are
+    templates, other files are read as they are even if they hold {{ or {%
+    Renders are kept in the salt_check cachedir, keyed by a hash of the template
+    and of the grains and pillar, so a template is only rendered again when it or
+    the minion's grains or pillar changed
+    '''
+
+    def __init__(self, scheck, cachedir):
+        self.scheck = scheck
+        self.path = os.path.join(cachedir, 'rendered_tests.json')
+        self.renders = _load_json_file(self.path)
+        self.templates = set()  # paths rendered during this run
+        self.changed = False
+        self._fingerprint = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def is_template(contents):
+        '''True if the text of a test file starts with a renderer line naming jinja'''
+        first_line = contents.split('\n', 1)[0].strip()
+        if not first_line.startswith('#!'):
+            return False
+        return 'jinja' in [renderer.strip() for renderer in first_line[2:].split('|')]
+
+    def fingerprint(self):
+        '''hash of the grains and pillar of the minion, fetched once'''
+        with self.lock:
+            if self._fingerprint is None:
+                context = [self.scheck.call_salt_command(fun=fun, args=None, kwargs=None)
+                           for fun in ('grains.items', 'pillar.raw')]
+                self._fingerprint = hashlib.md5(json.dumps(context, sort_keys=True, default=str)
+                                                .encode('utf-8')).hexdigest()
+            return self._fingerprint
+
+    def render(self, filepath, contents):
+        '''the rendered text of a template, from the cache when nothing changed'''
+        self.templates.add(filepath)
+        raw = contents if isinstance(contents, bytes) else contents.encode('utf-8')
+        key = hashlib.md5(raw).hexdigest() + self.fingerprint()
+        cached = self.renders.get(filepath, None)
+        if cached and cached['key'] == key:
+            return cached['contents']
+        rendered = self.scheck.call_salt_command(fun='file.apply_template_on_contents',
+                                                 args=None,
+                                                 kwargs={'contents': contents,
+                                                         'template': 'jinja',
+                                                         'context': None,
+                                                         'defaults': None,
+                                                         'saltenv': self.scheck.opts.get('environment', None) or 'base'})
+        if not isinstance(rendered, string_types):
+            raise ValueError("Unable to render {0}: {1}".format(filepath, rendered))
+        self.renders[filepath] = {'key': key, 'contents': rendered}
+        self.changed = True
+        return rendered
+
+    def save(self):
+        '''write the renders, if any changed'''
+        if self.changed:
+            _save_json_file(self.path, self.renders)
+            self.changed = False
+
+
 def _get_test_files(state_name):
     '''Given a path to the state files, gather the list of test files under
     the salt-check-test subdir'''
@@ -511,38 +1756,1047 @@ def _get_test_files(state_name):
 def _get_top_states():
     ''' Show the dirs for the top file used for a particular minion'''
     salt_check = SaltCheck()
-    return salt_check.get_top_states()
+    return [state for state, sls_names in salt_check.group_top_states(salt_check.get_top_states())]
+
+
+def _prefetch(iterable, size=100):
+    '''
+    Pull items from iterable in a background thread, at most size items ahead
+    Lets tests start running while later test files are still being read
+    iterable must not call salt functions, the salt loader is not shared across threads
+    '''
+    buf = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def reader():
+        try:
+            for item in iterable:
+                buf.put((None, item))
+                if stop.is_set():
+                    break
+        except Exception as err:
+            buf.put((err, None))
+        finally:
+            # closes the file the loader has open, if it was stopped early
+            close = getattr(iterable, 'close', None)
+            if close:
+                close()
+        if not stop.is_set():
+            buf.put((None, done))
+
+    thread = threading.Thread(target=reader, name='salt_check-loader')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            err, item = buf.get()
+            if err is not None:
+                raise err
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        # unblock the reader so it can see it was stopped
+        while not buf.empty():
+            buf.get_nowait()
+
+
+class RunHistory(object):
+    '''
+    Per-test results of every run, kept in a sqlite database in the salt_check cachedir
+    Rows are inserted in batches, and runs older than retention_days are pruned
+    when a run is closed
+    '''
+    BATCH_SIZE = 500
+    SCHEMA = ['''CREATE TABLE IF NOT EXISTS runs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    started REAL NOT NULL,
+                    finished REAL)''',
+              '''CREATE INDEX IF NOT EXISTS runs_started ON runs (started)''',
+              '''CREATE TABLE IF NOT EXISTS results (
+                    run_id INTEGER NOT NULL REFERENCES runs (id),
+                    state TEXT NOT NULL,
+                    test TEXT NOT NULL,
+                    passed INTEGER NOT NULL,
+                    cached INTEGER NOT NULL,
+                    duration REAL NOT NULL,
+                    fingerprint TEXT NOT NULL)''',
+              '''CREATE INDEX IF NOT EXISTS results_test ON results (state, test, run_id)''',
+              '''CREATE INDEX IF NOT EXISTS results_run ON results (run_id)''']
+    QUERIES = {
+        # average run time, cache hits left out
+        'slowest': '''SELECT state, test, AVG(duration), MAX(duration), COUNT(*)
+                      FROM results WHERE cached = 0 {where}
+                      GROUP BY state, test
+                      ORDER BY AVG(duration) DESC LIMIT ?''',
+        # tests that both passed and failed, the closer to half and half the flakier
+        'flakiest': '''SELECT state, test, SUM(passed), COUNT(*) - SUM(passed), COUNT(*)
+                       FROM results WHERE 1 = 1 {where}
+                       GROUP BY state, test
+                       HAVING SUM(passed) > 0 AND SUM(passed) < COUNT(*)
+                       ORDER BY MIN(SUM(passed), COUNT(*) - SUM(passed)) * 1.0 / COUNT(*) DESC,
+                                COUNT(*) DESC LIMIT ?''',
+        # tests whose last result differs from the one before it
+        'changed': '''SELECT r.state, r.test, r.passed, runs.started
+                      FROM results r JOIN runs ON runs.id = r.run_id
+                      WHERE r.run_id = (SELECT MAX(run_id) FROM results
+                                        WHERE state = r.state AND test = r.test)
+                      AND r.fingerprint != (SELECT fingerprint FROM results
+                                            WHERE state = r.state AND test = r.test
+                                            AND run_id < r.run_id
+                                            ORDER BY run_id DESC LIMIT 1) {where}
+                      ORDER BY r.run_id DESC LIMIT ?'''}
+    COLUMNS = {'slowest': ['state', 'test', 'average_duration', 'max_duration', 'runs'],
+               'flakiest': ['state', 'test', 'passed', 'failed', 'runs'],
+               'changed': ['state', 'test', 'passed', 'run_started']}
+
+    def __init__(self, cachedir, retention_days=30):
+        import sqlite3
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        self.path = os.path.join(cachedir, 'history.db')
+        self.retention_days = retention_days
+        self.conn = sqlite3.connect(self.path)
+        for statement in self.SCHEMA:
+            self.conn.execute(statement)
+        self.conn.commit()
+        self.run_id = None
+        self.pending = []
+
+    def start_run(self):
+        '''start recording a run'''
+        cursor = self.conn.execute("INSERT INTO runs (started) VALUES (?)", (time.time(),))
+        self.run_id = cursor.lastrowid
+
+    @staticmethod
+    def fingerprint(result):
+        '''short hash of a result, to tell when it changed'''
+        return hashlib.md5(u"{}".format(result).encode('utf-8')).hexdigest()[:16]
+
+    def record(self, state_name, test_name, result, duration, cached=False):
+        '''queue one test result, written in batches'''
+        if self.run_id is None:
+            self.start_run()
+        self.pending.append((self.run_id, state_name, test_name, int(result is True),
+                             int(cached), duration, self.fingerprint(result)))
+        if len(self.pending) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        '''write the queued results'''
+        if self.pending:
+            self.conn.executemany("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?)", self.pending)
+            self.conn.commit()
+            self.pending = []
+
+    def prune(self):
+        '''drop runs older than the retention period'''
+        cutoff = time.time() - self.retention_days * 86400
+        self.conn.execute("DELETE FROM results WHERE run_id IN "
+                          "(SELECT id FROM runs WHERE started < ?)", (cutoff,))
+        self.conn.execute("DELETE FROM runs WHERE started < ?", (cutoff,))
+        self.conn.commit()
+
+    def close(self):
+        '''finish the current run, prune old ones and close the database'''
+        self.flush()
+        if self.run_id is not None:
+            self.conn.execute("UPDATE runs SET finished = ? WHERE id = ?", (time.time(), self.run_id))
+            self.conn.commit()
+        self.prune()
+        self.conn.close()
+
+    def query(self, name, limit=10, state_name=None):
+        '''run one of QUERIES, return a list of dictionaries'''
+        if name not in self.QUERIES:
+            raise ValueError("query must be one of: {}".format(", ".join(sorted(self.QUERIES))))
+        params = []
+        where = ''
+        if state_name:
+            where = 'AND r.state = ?' if name == 'changed' else 'AND state = ?'
+            params.append(state_name)
+        params.append(int(limit))
+        rows = self.conn.execute(self.QUERIES[name].format(where=where), params).fetchall()
+        return [dict(zip(self.COLUMNS[name], row)) for row in rows]
+
+
+class ShellBatch(object):
+    '''
+    Runs many cmd.run / cmd.retcode tests in one shell, saving a shell start per test
+    Each command is exec-ed in its own subshell with stderr sent to stdout, like cmd.run,
+    and is followed by a delimiter line holding its index and exit code, which
+    splits the output back into one return per test
+    Only tests with a single command argument and no kwargs, pillar-data or eventually
+    are batched, and only plain commands (see plain_words): salt_check calls cmd.run
+    without a shell (python_shell=False), so pipes, globs, variables or redirections
+    would give other results in the batch than on their own
+    '''
+    FUNCTIONS = ('cmd.run', 'cmd.retcode')
+    # characters the shell treats specially, where cmd.run without a shell does not
+    SHELL_CHARACTERS = frozenset('|&;<>()$`\\"\'*?[]#~{}!\n\r')
+
+    def __init__(self, scheck):
+        self.scheck = scheck
+        self.token = 'salt-check-{}'.format(hashlib.md5(os.urandom(16)).hexdigest())
+
+    @classmethod
+    def is_batchable(cls, test):
+        '''True if a test can run as part of a batch'''
+        if not isinstance(test, dict) or test.get('module_and_function', None) not in cls.FUNCTIONS:
+            return False
+        if test.get('kwargs', None) or test.get('pillar-data', None) or test.get('eventually', None):
+            return False
+        args = test.get('args', None)
+        if not isinstance(args, list) or len(args) != 1 or not isinstance(args[0], string_types):
+            return False
+        return cls.plain_words(args[0]) is not None
+
+    @classmethod
+    def plain_words(cls, command):
+        '''
+        the words of a command the shell runs exactly as cmd.run does without a shell:
+        no quoting, expansion, redirection or other shell syntax, no variable assignment,
+        and a program found on the PATH (exec-ed, so not a shell builtin); None otherwise
+        '''
+        if cls.SHELL_CHARACTERS.intersection(command):
+            return None
+        words = command.split()
+        if not words or '=' in words[0] or not cls.find_program(words[0]):
+            return None
+        return words
+
+    @staticmethod
+    def find_program(name):
+        '''True if name is an executable file, or one on the PATH'''
+        if os.sep in name:
+            return os.path.isfile(name) and os.access(name, os.X_OK)
+        for path in os.environ.get('PATH', os.defpath).split(os.pathsep):
+            program = os.path.join(path, name)
+            if os.path.isfile(program) and os.access(program, os.X_OK):
+                return True
+        return False
+
+    def script(self, commands):
+        '''one shell script running each (plain) command, followed by its delimiter'''
+        lines = []
+        for index, command in enumerate(commands):
+            lines.append("( exec {} ) </dev/null 2>&1".format(command))
+            lines.append("printf '\\n%s %s %s\\n' '{}' {} $?".format(self.token, index))
+        return "\n".join(lines)
+
+    def split(self, stdout, count):
+        '''split the script output into (output, exit code) per command, None where missing'''
+        returns = [None] * count
+        output = []
+        for line in stdout.split("\n"):
+            fields = line.split(" ")
+            if len(fields) == 3 and fields[0] == self.token:
+                try:
+                    index, retcode = int(fields[1]), int(fields[2])
+                except ValueError:
+                    output.append(line)
+                    continue
+                if 0 <= index < count:
+                    returns[index] = ("\n".join(output).rstrip(), retcode)
+                output = []
+            else:
+                output.append(line)
+        return returns
+
+    def run(self, tests):
+        '''
+        run the commands of the tests, return what cmd.run / cmd.retcode would have
+        returned for each test, None for the tests the batch did not get to
+        '''
+        commands = [test['args'][0] for test in tests]
+        ret = self.scheck.call_salt_command(fun='cmd.run_all',
+                                            args=[self.script(commands)],
+                                            kwargs={'python_shell': True})
+        if not isinstance(ret, dict):
+            log.warning("salt_check shell batch failed: {}".format(ret))
+            return [None] * len(tests)
+        returns = []
+        for test, split in zip(tests, self.split(ret.get('stdout', ''), len(tests))):
+            if split is None:
+                returns.append(None)
+            elif test['module_and_function'] == 'cmd.retcode':
+                returns.append(split[1])
+            else:
+                returns.append(split[0])
+        return returns
+
+
+class FileCheckEngine(object):
+    '''
+    Answers file.file_exists and file.check_hash tests without going through salt,
+    with the same results: every path is stat-ed once, the files to hash are hashed
+    on a few threads (mmap-ed when large), and digests are kept in the salt_check
+    cachedir keyed by inode, size and mtime so unchanged files are not hashed again
+    Anything it cannot answer exactly like salt (e.g. an unknown hash type, or a
+    missing file, on which file.check_hash raises) is left to the salt function
+    '''
+    FUNCTIONS = ('file.file_exists', 'file.check_hash')
+    # hash type by length of the hex digest, as salt guesses it
+    HASH_TYPES = {32: 'md5', 40: 'sha1', 56: 'sha224', 64: 'sha256', 96: 'sha384', 128: 'sha512'}
+    MMAP_SIZE = 1024 * 1024
+    CHUNK_SIZE = 65536
+    THREADS = 4
+
+    def __init__(self, cachedir):
+        self.path = os.path.join(cachedir, 'file_digests.json')
+        self.digests = _load_json_file(self.path)
+
+    @classmethod
+    def is_native(cls, test):
+        '''True if the engine can answer a test'''
+        if not isinstance(test, dict) or test.get('module_and_function', None) not in cls.FUNCTIONS:
+            return False
+        if test.get('kwargs', None) or test.get('pillar-data', None) or test.get('eventually', None):
+            return False
+        args = test.get('args', None)
+        count = 1 if test['module_and_function'] == 'file.file_exists' else 2
+        return (isinstance(args, list) and len(args) == count
+                and all(isinstance(arg, string_types) for arg in args))
+
+    @classmethod
+    def parse_hash(cls, file_hash):
+        '''(hash type, hex digest) of a check_hash argument, None if salt would not accept it'''
+        for sep in (':', '='):
+            if sep in file_hash:
+                hash_type, hash_value = file_hash.split(sep, 1)
+                break
+        else:
+            hash_type, hash_value = cls.HASH_TYPES.get(len(file_hash), None), file_hash
+        if hash_type not in cls.HASH_TYPES.values():
+            return None
+        return hash_type, hash_value
+
+    def hash_file(self, path, size, hash_type):
+        '''hex digest of a file'''
+        digest = getattr(hashlib, hash_type)()
+        with open(path, 'rb') as myfile:
+            if size >= self.MMAP_SIZE:
+                import mmap
+                mapped = mmap.mmap(myfile.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    digest.update(mapped)
+                finally:
+                    mapped.close()
+            else:
+                for chunk in iter(functools.partial(myfile.read, self.CHUNK_SIZE), b''):
+                    digest.update(chunk)
+        return digest.hexdigest()
+
+    def stat_files(self, paths):
+        '''path -> stat of the file, None where it is not a regular file'''
+        import stat
+        stats = {}
+        for path in paths:
+            try:
+                result = os.stat(path)
+            except (IOError, OSError):
+                result = None
+            if result is not None and not stat.S_ISREG(result.st_mode):
+                result = None
+            stats[path] = result
+        return stats
+
+    def get_digest(self, path, result, hash_type):
+        '''the cached digest of a file, if the file did not change since it was hashed'''
+        cached = self.digests.get(path, None)
+        if cached and cached['stamp'] == [result.st_ino, result.st_size, result.st_mtime]:
+            return cached['hashes'].get(hash_type, None)
+        return None
+
+    def put_digest(self, path, result, hash_type, hexdigest):
+        '''cache the digest of a file'''
+        stamp = [result.st_ino, result.st_size, result.st_mtime]
+        cached = self.digests.get(path, None)
+        if not cached or cached['stamp'] != stamp:
+            cached = self.digests[path] = {'stamp': stamp, 'hashes': {}}
+        cached['hashes'][hash_type] = hexdigest
+
+    def hash_files(self, jobs):
+        '''(path, stat, hash type) -> hex digest, None where the file could not be read'''
+        todo = queue.Queue()
+        for job in jobs:
+            todo.put(job)
+        digests = {}
+
+        def work():
+            while True:
+                try:
+                    path, result, hash_type = todo.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    digests[(path, result, hash_type)] = self.hash_file(path, result.st_size, hash_type)
+                except (IOError, OSError, ValueError, TypeError) as err:
+                    log.info("Unable to hash {0}: {1}".format(path, err))
+
+        threads = [threading.Thread(target=work, name='salt-check-hash')
+                   for _ in range(min(self.THREADS, len(jobs)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return digests
+
+    def run(self, tests):
+        '''
+        what file.file_exists / file.check_hash would have returned for each test,
+        None for the tests left to salt
+        '''
+        paths = [os.path.expanduser(test['args'][0]) for test in tests]
+        stats = self.stat_files(set(paths))
+        wanted = []
+        for test in tests:
+            if test['module_and_function'] == 'file.check_hash':
+                wanted.append(self.parse_hash(test['args'][1]))
+            else:
+                wanted.append(None)
+        jobs = set()
+        for path, parsed in zip(paths, wanted):
+            result = stats[path]
+            if parsed and result is not None and self.get_digest(path, result, parsed[0]) is None:
+                jobs.add((path, result, parsed[0]))
+        for (path, result, hash_type), hexdigest in self.hash_files(list(jobs)).items():
+            self.put_digest(path, result, hash_type, hexdigest)
+        returns = []
+        for test, path, parsed in zip(tests, paths, wanted):
+            result = stats[path]
+            if test['module_and_function'] == 'file.file_exists':
+                returns.append(result is not None)
+            elif parsed is None or result is None:
+                returns.append(None)
+            else:
+                hexdigest = self.get_digest(path, result, parsed[0])
+                returns.append(None if hexdigest is None else hexdigest == parsed[1])
+        return returns
+
+    def save(self):
+        '''write the digest cache'''
+        _save_json_file(self.path, self.digests)
+
+
+class SuiteScheduler(object):
+    '''
+    Decides in which order the tests of a state run, and on how many threads
+    order is one of:
+      file      the order of the test files (the default when running on one thread)
+      duration  longest first, by recorded duration, else by the test's declared
+                "duration: SECONDS" (the default when running on several threads)
+      failing   tests that failed on their last run first, then longest first
+
+    Each test belongs to a resource class, with its own limit of tests running at
+    the same time (pkg calls share the package manager lock, so they run one at a time)
+    The class of a test is its "resource_class", else the class of its module.function
+    or module in the salt_check_resource_classes minion option, else of RESOURCE_CLASSES
+    Limits are set per class with the salt_check_concurrency minion option, e.g.
+      salt_check_resource_classes:
+        service: pkg
+        cmd.run: shell
+      salt_check_concurrency:
+        shell: 2
+    '''
+    ORDERS = ('file', 'duration', 'failing')
+    RESOURCE_CLASSES = {'pkg': 'pkg', 'lowpkg': 'pkg', 'pkg_resource': 'pkg', 'file': 'file'}
+    # classes not listed are limited only by the number of workers
+    CONCURRENCY = {'pkg': 1}
 
+    def __init__(self, durations, failures, order=None, workers=1, opts=None):
+        self.durations = durations
+        self.failures = failures
+        try:
+            self.workers = max(int(workers or 1), 1)
+        except (TypeError, ValueError):
+            raise ValueError("workers must be a number")
+        if not order:
+            order = 'duration' if self.workers > 1 else 'file'
+        if order not in self.ORDERS:
+            raise ValueError("order must be one of: {}".format(", ".join(self.ORDERS)))
+        self.order = order
+        opts = opts or {}
+        self.resource_classes = dict(self.RESOURCE_CLASSES)
+        self.resource_classes.update(opts.get('salt_check_resource_classes', None) or {})
+        self.concurrency = dict(self.CONCURRENCY)
+        self.concurrency.update(opts.get('salt_check_concurrency', None) or {})
+        # resource class: [tests, seconds waited, longest wait]
+        self.queue_times = {}
+
+    @staticmethod
+    def test_dict(test):
+        '''the dictionary of a test, which is either one or a CompiledTest'''
+        if isinstance(test, CompiledTest):
+            return test.test_dict
+        return test
+
+    def resource_class(self, test):
+        '''the resource class of a test'''
+        test = self.test_dict(test)
+        if not isinstance(test, dict):
+            return 'default'
+        if test.get('resource_class', None):
+            return str(test['resource_class'])
+        m_and_f = test.get('module_and_function', None)
+        if not isinstance(m_and_f, string_types):
+            return 'default'
+        for name in (m_and_f, m_and_f.split('.')[0]):
+            if name in self.resource_classes:
+                return self.resource_classes[name]
+        return 'default'
+
+    def limit(self, resource_class):
+        '''how many tests of a class may run at the same time'''
+        try:
+            return max(int(self.concurrency.get(resource_class, self.workers)), 1)
+        except (TypeError, ValueError):
+            return self.workers
+
+    def record_queue_time(self, resource_class, seconds):
+        '''add to the time tests of a class waited for a free slot'''
+        stats = self.queue_times.setdefault(resource_class, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+
+    def queue_report(self):
+        '''per resource class: tests run, total and longest seconds waited'''
+        return dict((resource_class, {'tests': stats[0],
+                                      'queued': round(stats[1], 4),
+                                      'longest': round(stats[2], 4)})
+                    for resource_class, stats in self.queue_times.items())
+
+    def estimate(self, state_name, test_name, test):
+        '''expected run time of a test, None if unknown'''
+        seconds = self.durations.get(state_name, test_name)
+        test = self.test_dict(test)
+        if seconds is None and isinstance(test, dict):
+            seconds = test.get('duration', None)
+        if isinstance(seconds, (int, float)):
+            return seconds
+        return None
+
+    def order_tests(self, state_name, tests):
+        '''return the (name, test) pairs in the order to run them'''
+        tests = list(tests)
+        if self.order == 'file':
+            return tests
+        estimates = [self.estimate(state_name, name, test) for name, test in tests]
+        known = [seconds for seconds in estimates if seconds is not None]
+        # tests never timed are assumed to take an average time
+        unknown = sum(known) / len(known) if known else 0
+        keys = {}
+        for (name, test), seconds in zip(tests, estimates):
+            failed = self.order == 'failing' and self.failures.is_failed(state_name, name)
+            keys[name] = (not failed, -(unknown if seconds is None else seconds))
+        return sorted(tests, key=lambda pair: keys[pair[0]])
+
+    def run(self, tests, run_one):
+        '''
+        call run_one on each (name, test) pair as soon as a worker and a slot of its
+        resource class are free; yield (what run_one returned, resource class, seconds queued)
+        as the tests finish
+        '''
+        if self.workers <= 1:
+            for item in tests:
+                resource_class = self.resource_class(item[1])
+                self.record_queue_time(resource_class, 0.0)
+                yield run_one(item), resource_class, 0.0
+            return
+        pending = [(item, self.resource_class(item[1])) for item in tests]
+        count = len(pending)
+        running = collections.defaultdict(int)
+        lock = threading.Condition()
+        done = queue.Queue()
+        queued_at = time.time()
+
+        def take():
+            '''the first pending test with a free slot in its class, None when all are taken'''
+            with lock:
+                while pending:
+                    for position, (item, resource_class) in enumerate(pending):
+                        if running[resource_class] < self.limit(resource_class):
+                            running[resource_class] += 1
+                            del pending[position]
+                            return item, resource_class
+                    lock.wait()
+                return None
+
+        def work():
+            while True:
+                taken = take()
+                if taken is None:
+                    return
+                item, resource_class = taken
+                queued = time.time() - queued_at
+                try:
+                    done.put((True, (run_one(item), resource_class, queued)))
+                except Exception as err:
+                    done.put((False, err))
+                finally:
+                    with lock:
+                        running[resource_class] -= 1
+                        lock.notify_all()
+
+        for _ in range(min(self.workers, count)):
+            thread = threading.Thread(target=work, name='salt-check-worker')
+            thread.daemon = True
+            thread.start()
+        for _ in range(count):
+            ok, value = done.get()
+            if not ok:
+                with lock:
+                    del pending[:]
+                    lock.notify_all()
+                raise value
+            self.record_queue_time(value[1], value[2])
+            yield value
+
+
+class ProgressEvents(object):
+    '''
+    Progress of a run fired on the minion event bus (event.send), coalesced to
+    one event per `every` results or per `interval` seconds, whichever comes first
+    Each event carries the counters so far and the tests that failed since the last one:
+      {'run': STARTED, 'passed': n, 'failed': n, 'total': n, 'elapsed': SECONDS,
+       'failed_tests': {STATE: [TEST, ...]}, 'finished': False}
+    The last event of a run has finished set to True
+    '''
+    TAG = 'salt_check/progress'
+
+    def __init__(self, scheck, every=50, interval=10):
+        self.scheck = scheck
+        self.every = max(int(every), 1)
+        self.interval = float(interval)
+        self.started = time.time()
+        self.last_fired = self.started
+        self.counts = {'passed': 0, 'failed': 0, 'total': 0}
+        self.pending = 0
+        self.failed_tests = {}
+
+    def add(self, state_name, test_name, result):
+        '''count one result, fire an event when enough results or time piled up'''
+        self.counts['total'] += 1
+        if result is True:
+            self.counts['passed'] += 1
+        else:
+            self.counts['failed'] += 1
+            self.failed_tests.setdefault(state_name, []).append(test_name)
+        self.pending += 1
+        if self.pending >= self.every or time.time() - self.last_fired >= self.interval:
+            self.fire()
+
+    def fire(self, finished=False):
+        '''send the counters and the tests failed since the last event'''
+        now = time.time()
+        data = dict(self.counts,
+                    run=self.started,
+                    elapsed=round(now - self.started, 3),
+                    failed_tests=self.failed_tests,
+                    finished=finished)
+        ret = self.scheck.call_salt_command(fun='event.send',
+                                            args=[self.TAG],
+                                            kwargs={'data': data})
+        if ret is not True:
+            log.warning("Unable to send salt_check progress event: {}".format(ret))
+        self.last_fired = now
+        self.pending = 0
+        self.failed_tests = {}
+
+    def finish(self):
+        '''fire the last event of the run'''
+        self.fire(finished=True)
+
+
+class SuiteRun(object):
+    '''
+    One run of state tests, holds what the states of a run share
+    With details each test result is a dictionary:
+      {'result': RESULT, 'duration': SECONDS, 'cached': True if the return came from the ResultCache,
+       'resource_class': CLASS, 'queued': SECONDS WAITED FOR A WORKER AND A SLOT OF THE CLASS}
+    and, for tests with eventually, 'attempts' and 'time_to_pass' (None if it never passed)
+    Tests left out by their only_if_grains / unless_grains are not run, their
+    result is "Skipped: REASON" ({'result': ..., 'skipped': True} with details)
+    '''
+
+    def __init__(self, scheck, sharder=None, suite_filter=None, details=False, history=None,
+                 workers=None, order=None, batch_shell=None, native_files=None, progress=None):
+        self.scheck = scheck
+        self.sharder = sharder
+        self.suite_filter = suite_filter
+        self.details = details
+        if batch_shell is None:
+            batch_shell = scheck.opts.get('salt_check_batch_shell', False)
+        self.batch_shell = batch_shell
+        if native_files is None:
+            native_files = scheck.opts.get('salt_check_native_files', False)
+        self.file_engine = None
+        if native_files:
+            self.file_engine = FileCheckEngine(scheck.get_salt_check_cachedir())
+        if progress is None:
+            progress = scheck.opts.get('salt_check_progress', False)
+        self.progress = None
+        if progress:
+            self.progress = ProgressEvents(scheck,
+                                           every=scheck.opts.get('salt_check_progress_every', 50),
+                                           interval=scheck.opts.get('salt_check_progress_interval', 10))
+        cachedir = scheck.get_salt_check_cachedir()
+        self.durations = SuiteDurations(cachedir)
+        self.failures = SuiteFailures(cachedir)
+        if workers is None:
+            workers = scheck.opts.get('salt_check_workers', 1)
+        if order is None:
+            order = scheck.opts.get('salt_check_order', None)
+        self.polls = {}  # (state, test) -> attempts and time_to_pass of tests with eventually
+        self.scheduler = SuiteScheduler(self.durations, self.failures, order=order, workers=workers,
+                                        opts=scheck.opts)
+        # the grains tests are picked by, as they were before any test ran
+        self.grain_selector = GrainSelector(scheck.call_salt_command(fun='grains.items',
+                                                                     args=None, kwargs=None))
+        self.index = SuiteIndex(cachedir)
+        self.renderer = SuiteRenderer(scheck, cachedir)
+        self.result_cache = ResultCache(cachedir, scheck.opts)
+        if history is None:
+            history = scheck.opts.get('salt_check_history', False)
+        self.history = None
+        if history:
+            self.history = RunHistory(cachedir, scheck.opts.get('salt_check_history_days', 30))
+
+    def run_state(self, state_name, sls_names=None):
+        '''Run the tests of one state, with sls_names only those of these sls of it'''
+        results_dict = {}
+        paths = self.scheck.get_state_search_path_list()
+        #log.info("State search paths: {}".format(paths))
+        stl = StateTestLoader(search_paths=paths, renderer=self.renderer)
+        mydir = stl.find_state_dir(state_name)
+        #log.info("mydir: {}".format(mydir))
+        if mydir:
+            stl.gather_files(mydir)
+            tests = stl.iter_tests(self.suite_filter, self.index, sls_names)
+            if self.sharder:
+                tests = self.sharder.select(state_name, tests)
+            skipped = []
+            tests = self.grain_selector.select(tests, stl.errors, skipped)
+            if self.scheduler.order == 'file':
+                # the loader thread only reads and parses files; salt calls, which the
+                # tests make too, stay on this thread: templates are rendered first and
+                # tests compiled as they come out of the loader
+                stl.render_templates(sls_names)
+                tests = self.compile_plan(stl.errors, _prefetch(tests))
+            else:
+                tests = self.scheduler.order_tests(state_name, self.compile_plan(stl.errors, tests))
+            run_one = functools.partial(self.run_one, state_name, stl.errors)
+            outcomes = []
+            if self.file_engine:
+                native, tests = self.split_tests(stl.errors, tests, FileCheckEngine.is_native)
+                outcomes.append(self.run_grouped(native, self.file_engine.run))
+            if self.batch_shell:
+                batch, tests = self.split_tests(stl.errors, tests, self.is_batchable)
+                outcomes.append(self.run_grouped(batch, ShellBatch(self.scheck).run))
+            outcomes.append(self.scheduler.run(tests, run_one))
+            for outcome, resource_class, queued in itertools.chain(*outcomes):
+                key, result, duration, cached = outcome
+                if not cached:
+                    self.durations.record(state_name, key, duration)
+                self.failures.record(state_name, key, result)
+                if self.history:
+                    self.history.record(state_name, key, result, duration, cached)
+                if self.progress:
+                    self.progress.add(state_name, key, result)
+                if self.details:
+                    result = {'result': result,
+                              'duration': round(duration, 4),
+                              'cached': cached,
+                              'resource_class': resource_class,
+                              'queued': round(queued, 4)}
+                    result.update(self.polls.pop((state_name, key), {}))
+                results_dict[key] = result
+            for key, reason in skipped:
+                log.info("{0} {1}".format(key, reason))
+                if self.details:
+                    reason = {'result': reason, 'duration': 0.0, 'cached': False, 'skipped': True}
+                results_dict[key] = reason
+            #log.info("State Name = {}, results_dict: {}".format(state_name, results_dict))
+        return {state_name: results_dict}
+
+    def compile_plan(self, errors, tests):
+        '''
+        Turn (name, test) pairs into the plan of the run, (name, CompiledTest) pairs,
+        each test compiled once as the suite is loaded, before it is scheduled
+        Tests with schema errors are not compiled, run_one reports them
+        '''
+        for key, value in tests:
+            if key in errors:
+                yield key, CompiledTest.invalid(key, value)
+            else:
+                yield key, self.scheck.compile_test(key, value)
+
+    def is_batchable(self, test):
+        '''True if a test can run in a ShellBatch'''
+        return ShellBatch.is_batchable(test) and not self.result_cache.get_ttl(test)
+
+    @staticmethod
+    def split_tests(errors, tests, predicate):
+        '''split (name, CompiledTest) pairs into those predicate picks by test dict and the others'''
+        picked = []
+        others = []
+        for key, value in tests:
+            if key not in errors and predicate(value.test_dict):
+                picked.append((key, value))
+            else:
+                others.append((key, value))
+        return picked, others
+
+    def run_grouped(self, tests, run_all):
+        '''
+        Run (name, CompiledTest) pairs together with run_all (ShellBatch.run, FileCheckEngine.run),
+        which returns the salt function return of each test, None for those it could not run;
+        those are run on their own. Yields like SuiteScheduler.run
+        '''
+        compiled = [test for key, test in tests]
+        valid = [test for test in compiled if test.valid]
+        returns = {}
+        each = 0.0
+        if valid:
+            start = time.time()
+            returns = dict(zip([test.name for test in valid],
+                               run_all([test.test_dict for test in valid])))
+            each = (time.time() - start) / len(valid)
+        for test in compiled:
+            resource_class = self.scheduler.resource_class(test.test_dict)
+            if not test.valid:
+                yield (test.name, "False: Invalid test", 0.0, False), resource_class, 0.0
+                continue
+            returned = self.scheck.spill(returns.pop(test.name, None))
+            duration = each
+            if returned is None:
+                start = time.time()
+                returned = self.scheck.spill(test.call())
+                duration = time.time() - start
+            yield (test.name, self.scheck.check_return(test, returned), duration, False), resource_class, 0.0
+
+    def run_one(self, state_name, errors, item):
+        '''Run one (name, CompiledTest) pair of the plan; returns (name, result, duration, cached)'''
+        key, compiled = item
+        start = time.time()
+        cached = False
+        if key in errors:
+            result = "False: Invalid test: {}".format("; ".join(errors[key]))
+        else:
+            result, cached = self.run_test(state_name, compiled)
+        return key, result, time.time() - start, cached
+
+    def run_test(self, state_name, compiled):
+        '''Run one compiled test, using the ResultCache if it is cacheable; returns (result, cached)'''
+        if not compiled.valid:
+            return "False: Invalid test", False
+        test_dict = compiled.test_dict
+        eventually = self.scheck.eventually_options(test_dict.get('eventually', None))
+        if eventually:
+            result, attempts, time_to_pass = self.scheck.check_eventually(compiled, eventually)
+            log.info("{0} {1} after {2} attempts".format(
+                compiled.name, "passed" if result is True else "failed", attempts))
+            self.polls[(state_name, compiled.name)] = {'attempts': attempts,
+                                                       'time_to_pass': time_to_pass}
+            return result, False
+        ttl = self.result_cache.get_ttl(test_dict)
+        cached = False
+        if ttl:
+            cached, actual_return = self.result_cache.get(state_name, test_dict, ttl)
+        if not cached:
+            actual_return = self.scheck.spill(compiled.call())
+            if ttl and not isinstance(actual_return, SpilledReturn):
+                self.result_cache.put(state_name, test_dict, ttl, actual_return)
+        return self.scheck.check_return(compiled, actual_return), cached
+
+    def finish(self):
+        '''Save what was learned during the run'''
+        if self.result_cache.hits:
+            log.info("salt_check result cache hits: {}".format(self.result_cache.hits))
+        if self.scheduler.workers > 1:
+            log.info("salt_check queue times per resource class: {}".format(
+                self.scheduler.queue_report()))
+        self.durations.save()
+        self.failures.save()
+        if self.file_engine:
+            self.file_engine.save()
+        self.index.save()
+        self.renderer.save()
+        self.result_cache.save()
+        if self.history:
+            self.history.close()
+        if self.progress:
+            self.progress.finish()
+
+
+class SuiteValidator(object):
+    '''
+    Checks test suites without running them: every test file is parsed and
+    every test checked against the test layout and against the functions
+    available on the minion, fetched with a single sys.list_functions call
+    '''
+
+    def __init__(self, scheck):
+        self.scheck = scheck
+        cachedir = scheck.get_salt_check_cachedir()
+        self.durations = SuiteDurations(cachedir)
+        self.renderer = SuiteRenderer(scheck, cachedir)
+        self.catalog = self.get_catalog()
+
+    def get_catalog(self):
+        '''return the set of all functions on the minion, or None if unavailable'''
+        functions = self.scheck.call_salt_command(fun='sys.list_functions',
+                                                  args=None,
+                                                  kwargs=None)
+        if not isinstance(functions, list):
+            log.warning("Unable to list salt functions, not checking them: {}".format(functions))
+            return None
+        return set(functions)
 
-def run_state_tests(state_name):
+    def check_test(self, test):
+        '''return the problems that would make a test report "False: Invalid test"'''
+        problems = StateTestLoader.check_test_schema(test)
+        if problems:
+            return problems
+        if self.catalog is not None and test['module_and_function'] not in self.catalog:
+            problems.append("{} is not available on this minion".format(test['module_and_function']))
+        if test['assertion'] not in self.scheck.assertions_list:
+            problems.append("unknown assertion {}".format(test['assertion']))
+        if not test['expected-return']:
+            problems.append("expected-return must not be empty")
+        return problems
+
+    @staticmethod
+    def iter_file_tests(stl, filepath):
+        '''yield (test name, test, line number or None) from a test file'''
+        file_format = TEST_FILE_FORMATS.get(os.path.splitext(filepath)[1], 'yaml')
+        if file_format == 'yaml':
+            documents = stl.iter_yaml_documents_with_lines(filepath)
+        else:
+            documents = ((contents, {}) for contents in
+                         getattr(stl, 'iter_{}_documents'.format(file_format))(filepath))
+        for contents, lines in documents:
+            if contents is None:
+                continue
+            if not isinstance(contents, dict):
+                raise ValueError("a document in the file is not a set of tests")
+            for key, value in contents.items():
+                yield key, value, lines.get(key, None)
+
+    @staticmethod
+    def error_line(err):
+        '''line number of a parse error, if the parser gave one'''
+        mark = getattr(err, 'problem_mark', None)
+        if mark is not None:
+            return mark.line + 1
+        return getattr(err, 'lineno', None)
+
+    def validate_state(self, state_name):
+        '''
+        Return {'tests': n, 'errors': [...], 'estimated_seconds': x, 'unmeasured_tests': n}
+        for one state, each error being {'file', 'line', 'test', 'error'}
+        '''
+        stl = StateTestLoader(search_paths=self.scheck.get_state_search_path_list(),
+                              renderer=self.renderer)
+        mydir = stl.find_state_dir(state_name)
+        report = {'tests': 0, 'errors': [], 'estimated_seconds': 0.0, 'unmeasured_tests': 0}
+        if not mydir:
+            report['errors'].append({'file': None, 'line': None, 'test': None,
+                                     'error': "no salt-check-tests dir found for {}".format(state_name)})
+            return report
+        stl.gather_files(mydir)
+        for filepath in stl.test_files:
+            try:
+                for key, value, line in self.iter_file_tests(stl, filepath):
+                    report['tests'] += 1
+                    problems = self.check_test(value)
+                    if stl.is_duplicate(key, filepath):
+                        problems.append("duplicate test name, already defined in {}".format(
+                            stl.test_sources[key]))
+                    for problem in problems:
+                        report['errors'].append({'file': filepath, 'line': line,
+                                                 'test': key, 'error': problem})
+                    duration = self.durations.get(state_name, key)
+                    if duration is None:
+                        report['unmeasured_tests'] += 1
+                    else:
+                        report['estimated_seconds'] += duration
+            except Exception as err:
+                report['errors'].append({'file': filepath, 'line': self.error_line(err),
+                                         'test': None, 'error': str(err)})
+        report['estimated_seconds'] = round(report['estimated_seconds'], 3)
+        self.renderer.save()
+        return report
+
+
+def _get_sharder(shard, shard_weights=None):
+    '''Build a SuiteSharder for a "i/n" shard option, or None when not sharding'''
+    if not shard:
+        return None
+    weights = None
+    if shard_weights:
+        weights = _load_json_file(shard_weights)
+    return SuiteSharder(shard, weights=weights)
+
+
+def run_state_tests(state_name, shard=None, shard_weights=None,
+                    include=None, exclude=None, tags=None, details=False, history=None,
+                    workers=None, order=None, batch_shell=None, native_files=None, progress=None):
     '''
-    Runs tests for one state
+    Runs tests for one state, or for one sls of it (e.g. apache.vhost_web1: the
+    tests of that sls and those of the state as a whole, see StateTestLoader)
+    Tests can be picked by name with include / exclude glob patterns,
+    and by tags (any of), each a list or comma separated
     CLI Example:
         salt '*' salt_check.run_state_tests STATE-NAME
+        salt '*' salt_check.run_state_tests STATE-NAME.SLS-NAME
+        salt '*' salt_check.run_state_tests STATE-NAME shard=1/4
+        salt '*' salt_check.run_state_tests STATE-NAME include='*conf*' exclude='*mode' tags=smoke
+        salt '*' salt_check.run_state_tests STATE-NAME details=True
+        salt '*' salt_check.run_state_tests STATE-NAME workers=4 order=failing
+    With details=True each result also shows its duration, and whether it came from the result cache
+    With history=True (default: the salt_check_history minion option) results are also recorded
+    in the run history, see salt_check.history
+    workers=N (default: the salt_check_workers minion option, 1) runs N tests at a time,
+    order=file|duration|failing (default: the salt_check_order minion option) picks which
+    run first, see SuiteScheduler
+    batch_shell=True (default: the salt_check_batch_shell minion option) runs the
+    cmd.run / cmd.retcode tests of a state in one shell, see ShellBatch
+    native_files=True (default: the salt_check_native_files minion option) answers
+    file.file_exists / file.check_hash tests without salt, see FileCheckEngine
+    progress=True (default: the salt_check_progress minion option) fires progress events
+    tagged salt_check/progress, see ProgressEvents
+    Tests with only_if_grains / unless_grains not meant for this minion are reported
+    as "Skipped: ...", without being run, see GrainSelector
     '''
     log.info("run_state_test time: {}".format(time.time()))
-    results_dict = {}
     if not state_name:
         return "State name required"
+    try:
+        sharder = _get_sharder(shard, shard_weights)
+    except ValueError as err:
+        return str(err)
     scheck = SaltCheck()
     #log.info("Creating SaltCheck instance")
     # this should be done manually instead scheck.cache_master_files()
-    log.info("Caching master files")
-    paths = scheck.get_state_search_path_list()
-    #log.info("State search paths: {}".format(paths))
-    stl = StateTestLoader(search_paths=paths)
-    mydir = stl.find_state_dir(state_name)
-    #log.info("mydir: {}".format(mydir))
-    if mydir:
-        stl.gather_files(mydir)
-        _get_test_files(state_name)
-        stl.load_test_suite()
-        results_dict = {}
-        for key, value in stl.test_dict.items():
-            result = scheck.run_test(value)
-            results_dict[key] = result
-        #log.info("State Name = {}, results_dict: {}".format(state_name, results_dict))
-    return {state_name: results_dict}
+    try:
+        suite_run = SuiteRun(scheck, sharder, SuiteFilter(include, exclude, tags),
+                             details=details, history=history, workers=workers, order=order,
+                             batch_shell=batch_shell, native_files=native_files,
+                             progress=progress)
+    except ValueError as err:
+        return str(err)
+    # doing this to handle states with periods
+    # e.g.  apache.vhost_web1
+    state, sls_names = scheck.group_top_states([state_name])[0]
+    if sls_names == [state]:
+        sls_names = None
+    ret_dict = suite_run.run_state(state, sls_names)
+    suite_run.finish()
+    return {state_name: ret_dict[state]}
 
 
 def update_master_cache():
@@ -558,22 +2812,150 @@ def update_master_cache():
     scheck.cache_master_files()
     return True
 
-def run_highstate_tests():
+def clear_result_cache():
+    '''
+    Drops all cached returns of cacheable tests
+    CLI Example:
+        salt '*' salt_check.clear_result_cache
+    '''
+    scheck = SaltCheck()
+    result_cache = ResultCache(scheck.get_salt_check_cachedir(), scheck.opts)
+    result_cache.clear()
+    result_cache.save()
+    return True
+
+
+def run_highstate_tests(shard=None, shard_weights=None,
+                        include=None, exclude=None, tags=None, details=False, history=None,
+                        workers=None, order=None, batch_shell=None, native_files=None,
+                        progress=None):
     '''
     Runs tests for all states included in a highstate
+    Only the tests of the sls in the minion's top are run, e.g. with apache.vhost_web1
+    in the top the tests of apache.vhost_web2 are left out
+    Takes the same shard, test picking, details, history, workers, order,
+    batch_shell, native_files and progress options as run_state_tests
     CLI Example:
         salt '*' salt_check.run_highstate_tests
+        salt '*' salt_check.run_highstate_tests shard=1/4 shard_weights=/tmp/durations.json
+        salt '*' salt_check.run_highstate_tests tags=smoke
     '''
-    states = _get_top_states()
+    try:
+        sharder = _get_sharder(shard, shard_weights)
+    except ValueError as err:
+        return str(err)
+    scheck = SaltCheck()
+    states = scheck.group_top_states(scheck.get_top_states())
     #log.info("States:  {}".format(states))
+    try:
+        suite_run = SuiteRun(scheck, sharder, SuiteFilter(include, exclude, tags),
+                             details=details, history=history, workers=workers, order=order,
+                             batch_shell=batch_shell, native_files=native_files,
+                             progress=progress)
+    except ValueError as err:
+        return str(err)
     return_dict = {}
-    for state in states:
-        log.info("Running state test: {} @ {}".format(state, time.time()))
-        ret_dict = run_state_tests(state)
+    for state, sls_names in states:
+        log.info("Running state test: {0} ({1}) @ {2}".format(state, ", ".join(sls_names), time.time()))
+        ret_dict = suite_run.run_state(state, sls_names)
         return_dict.update(ret_dict)
+    suite_run.finish()
     return return_dict
 
 
+def history(query='slowest', limit=10, state=None):
+    '''
+    Queries the run history (recorded when salt_check_history is on, or with history=True)
+    query is one of:
+      slowest   tests with the longest average run time
+      flakiest  tests that both passed and failed, closest to half and half first
+      changed   tests whose latest result differs from the one before it
+    CLI Example:
+        salt '*' salt_check.history
+        salt '*' salt_check.history flakiest limit=20
+        salt '*' salt_check.history changed state=apache
+    '''
+    scheck = SaltCheck()
+    run_history = RunHistory(scheck.get_salt_check_cachedir())
+    try:
+        return run_history.query(query, limit=limit, state_name=state)
+    except ValueError as err:
+        return str(err)
+    finally:
+        run_history.conn.close()
+
+
+def _set_retcode(reports):
+    '''make salt return a non-zero exit code when a suite has errors'''
+    if any(report['errors'] for report in reports.values()):
+        try:
+            __context__['retcode'] = 1
+        except NameError:
+            pass
+
+
+def validate_state_tests(state_name):
+    '''
+    Checks the tests of one state without running any of them
+    Reports every problem with file and line number, and an estimate of
+    the run time from recorded test durations
+    CLI Example:
+        salt '*' salt_check.validate_state_tests STATE-NAME
+    '''
+    if not state_name:
+        return "State name required"
+    validator = SuiteValidator(SaltCheck())
+    reports = {state_name: validator.validate_state(state_name)}
+    _set_retcode(reports)
+    return reports
+
+
+def validate_highstate_tests():
+    '''
+    Checks the tests of all states included in a highstate without running any of them
+    CLI Example:
+        salt '*' salt_check.validate_highstate_tests
+    '''
+    scheck = SaltCheck()
+    validator = SuiteValidator(scheck)
+    reports = {}
+    for state, sls_names in scheck.group_top_states(scheck.get_top_states()):
+        reports[state] = validator.validate_state(state)
+    _set_retcode(reports)
+    return reports
+
+
+def merge_shards(*paths):
+    '''
+    Combines the saved output of sharded runs into one report
+    Files may be json (e.g. salt-call --out=json) or yaml
+    CLI Example:
+        salt-call --local salt_check.merge_shards shard1.json shard2.json
+    '''
+    merged = {}
+    for path in paths:
+        with open(path, 'r') as myfile:
+            if path.endswith('.json'):
+                contents = json.load(myfile)
+            else:
+                contents = yaml.safe_load(myfile)
+        if not isinstance(contents, dict):
+            log.warning("merge_shards: skipping {}, no results found".format(path))
+            continue
+        # salt-call output wraps the return as {"local": RETURN}
+        if list(contents.keys()) == ['local'] and isinstance(contents['local'], dict):
+            contents = contents['local']
+        for state_name, results in contents.items():
+            state_results = merged.setdefault(state_name, {})
+            if not isinstance(results, dict):
+                continue
+            for test_name, result in results.items():
+                if test_name in state_results:
+                    log.warning("merge_shards: {0} {1} found in more than one shard".format(state_name, test_name))
+                state_results[test_name] = result
+    return merged
+
+
 def run_test(**kwargs):
     '''
     Enables running one salt_check test via cli
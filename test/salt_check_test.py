@@ -2,24 +2,1105 @@
 import unittest
 import sys, os, os.path
 import yaml
+import functools
+import hashlib
+import json
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
 sys.path.append(os.path.abspath(sys.path[0]) + '/../')
 from salt_check import SaltCheck
+from salt_check import SaltFunctionCaller
 from salt_check import StateTestLoader
+from salt_check import SuiteSharder
+from salt_check import SuiteFilter
+from salt_check import SuiteIndex
+from salt_check import ResultCache
+from salt_check import RunHistory
+from salt_check import SuiteDurations
+from salt_check import SuiteFailures
+from salt_check import SuiteScheduler
+from salt_check import ShellBatch
+from salt_check import FileCheckEngine
+from salt_check import PillarCache
+from salt_check import SuiteRenderer
+from salt_check import SpilledReturn
+from salt_check import ProgressEvents
+from salt_check import GrainSelector
+from salt_check import CompiledTest
+from salt_check import SuiteRun
+from salt_check import SuiteValidator
+from salt_check import merge_shards
+from salt_check import _prefetch
+import salt_check
 
 # Note: the order tests are run is arbitrary!
 
+class FakeSaltCheck(object):
+    '''
+    Stands in for a SaltCheck where only call_salt_command, opts and paths are used:
+    salt functions are answered by the callables in salt_functions (name -> callable
+    taking the args and kwargs of the call), and every call is recorded in calls
+    '''
+
+    def __init__(self, salt_functions=None, opts=None, cachedir=None, search_paths=None):
+        self.salt_functions = salt_functions or {}
+        self.opts = opts or {}
+        self.cachedir = cachedir
+        self.search_paths = search_paths or []
+        self.assertions_list = list(SaltCheck.ASSERTIONS)
+        self.calls = []  # (fun, args, kwargs)
+
+    def get_salt_check_cachedir(self):
+        return self.cachedir
+
+    def get_state_search_path_list(self):
+        return self.search_paths
+
+    def call_salt_command(self, fun, args=None, kwargs=None):
+        self.calls.append((fun, args, kwargs))
+        return self.salt_functions[fun](*(args or []), **(kwargs or {}))
+
+    def calls_of(self, fun):
+        '''the (args, kwargs) of every call of one salt function'''
+        return [(args, kwargs) for name, args, kwargs in self.calls if name == fun]
+
+
 class MyClass2(unittest.TestCase):
 
     def setUp(self):
         self.st = StateTestLoader("/tmp")
+        self.tmpdir = tempfile.mkdtemp()
 
     def tearDown(self):
-        pass
+        shutil.rmtree(self.tmpdir)
+
+    def write_file(self, name, contents):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as myfile:
+            myfile.write(contents)
+        return path
+
+    def test_iter_file_1(self):
+        path = self.write_file("1.tst", "test-a:\n  assertion: assertTrue\n"
+                                        "---\n"
+                                        "test-b:\n  assertion: assertFalse\n")
+        val = [key for key, value in self.st.iter_file(path)]
+        self.assertEqual(val, ["test-a", "test-b"])
+
+    def test_iter_tests_1(self):
+        self.st.test_files = [self.write_file("1.tst", "test-a:\n  assertion: assertTrue\n"),
+                              self.write_file("2.tst", "test-a:\n  assertion: assertFalse\n")]
+        val = dict(self.st.iter_tests())
+        self.assertEqual(val, {"test-a": {"assertion": "assertTrue"}})
+        self.assertEqual(len(self.st.duplicates), 1)
+
+    def test_iter_file_2(self):
+        path = self.write_file("1.json", '[{"test-a": {"assertion": "assertTrue"}}, '
+                                         '{"test-b": {"assertion": "assertFalse"}}]')
+        val = [key for key, value in self.st.iter_file(path)]
+        self.assertEqual(val, ["test-a", "test-b"])
+
+    @unittest.skipUnless(salt_check.HAS_MSGPACK, "msgpack is not installed")
+    def test_iter_file_3(self):
+        import msgpack
+        path = os.path.join(self.tmpdir, "1.msgpack")
+        with open(path, 'wb') as myfile:
+            myfile.write(msgpack.packb({"test-a": {"assertion": "assertTrue"}}))
+            myfile.write(msgpack.packb({"test-b": {"assertion": "assertFalse"}}))
+        val = [key for key, value in self.st.iter_file(path)]
+        self.assertEqual(val, ["test-a", "test-b"])
+
+    def test_iter_file_4(self):
+        path = os.path.join(self.tmpdir, "1.msgpack")
+        with open(path, 'wb') as myfile:
+            myfile.write(b"\x81")
+        has_msgpack = salt_check.HAS_MSGPACK
+        salt_check.HAS_MSGPACK = False
+        try:
+            # without the msgpack library the file is reported and left out
+            val = list(self.st.iter_file(path))
+        finally:
+            salt_check.HAS_MSGPACK = has_msgpack
+        self.assertEqual(val, [])
+
+    def test_iter_tests_2(self):
+        self.st.test_files = [self.write_file("1.tst", "test-a:\n  tags: [smoke]\n"),
+                              self.write_file("2.tst", "test-b:\n  tags: [slow]\n")]
+        index = SuiteIndex(self.tmpdir)
+        val = dict(self.st.iter_tests(SuiteFilter(tags="smoke"), index))
+        self.assertEqual(list(val), ["test-a"])
+        self.assertEqual(index.get(self.st.test_files[1]), {"test-b": ["slow"]})
+
+    def test_iter_tests_3(self):
+        path = self.write_file("1.tst", "test-a:\n  tags: [smoke]\n")
+        size, mtime = SuiteIndex.file_stamp(path)
+        index = SuiteIndex(self.tmpdir)
+        index.update(path, size, mtime, {"test-a": ["slow"]})
+        self.st.test_files = [path]
+        # the index says the file holds no smoke test, so it is not read
+        val = dict(self.st.iter_tests(SuiteFilter(tags="smoke"), index))
+        self.assertEqual(val, {})
+
+    def test_iter_tests_4(self):
+        first = self.write_file("1.tst", "test-x:\n  tags: [smoke]\n")
+        second = self.write_file("2.tst", "test-x:\n  tags: [smoke]\n")
+        index = SuiteIndex(self.tmpdir)
+        self.st.test_files = [first, second]
+        dict(self.st.iter_tests(None, index))
+        # the duplicate is indexed too, so renaming the first test-x does not hide the second
+        self.assertEqual(index.get(second), {"test-x": ["smoke"]})
+        self.write_file("1.tst", "test-y:\n  tags: [slow, renamed]\n")
+        st = StateTestLoader("/tmp")
+        st.test_files = [first, second]
+        val = dict(st.iter_tests(SuiteFilter(tags="smoke"), index))
+        self.assertEqual(list(val), ["test-x"])
+
+    def test_prefetch_1(self):
+        produced = []
+        closed = threading.Event()
+
+        def source():
+            try:
+                for i in range(1000):
+                    produced.append(i)
+                    yield i
+            finally:
+                closed.set()
+
+        tests = _prefetch(source(), size=2)
+        self.assertEqual([next(tests) for _ in range(3)], [0, 1, 2])
+        tests.close()
+        # the loader thread stops, and closes the source, once the consumer is gone
+        self.assertTrue(closed.wait(5))
+        self.assertLess(len(produced), 10)
+        deadline = time.time() + 5
+        while any(thread.name == 'salt_check-loader' for thread in threading.enumerate()):
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def test_prefetch_2(self):
+        self.st.test_files = [self.write_file("1.tst", "test-a:\n  assertion: assertTrue\n"),
+                              self.write_file("2.tst", "test-b:\n  args: [unclosed\n")]
+        tests = _prefetch(self.st.iter_tests())
+        self.assertEqual(next(tests)[0], "test-a")
+        # a broken file read by the loader thread raises in the caller
+        self.assertRaises(yaml.YAMLError, next, tests)
+
+    def test_iter_yaml_documents_with_lines_1(self):
+        path = self.write_file("1.tst", "test-a:\n  assertion: assertTrue\n"
+                                        "\n"
+                                        "test-b:\n  assertion: assertFalse\n")
+        val = [lines for contents, lines in self.st.iter_yaml_documents_with_lines(path)]
+        self.assertEqual(val, [{"test-a": 1, "test-b": 4}])
+
+    def test_check_test_schema_1(self):
+        test = {"module_and_function": "test.echo",
+                "args": ["This works!"],
+                "assertion": "assertEqual",
+                "expected-return": "This works!"}
+        val = StateTestLoader.check_test_schema(test)
+        self.assertEqual(val, [])
+
+    def test_check_test_schema_2(self):
+        test = {"module_and_function": "test.echo.twice",
+                "assertion": "assertEqual"}
+        val = StateTestLoader.check_test_schema(test)
+        self.assertEqual(len(val), 2)
+
+    def test_iter_tests_sls_1(self):
+        state_dir = os.path.join(self.tmpdir, "apache")
+        for subdir in ("vhost_web1", "vhost_web2"):
+            os.makedirs(os.path.join(state_dir, "salt-check-tests", subdir))
+        self.write_file("apache/salt-check-tests/1.tst",
+                        "common:\n  assertion: assertTrue\n"
+                        "by-key:\n  sls: vhost_web2\n")
+        self.write_file("apache/salt-check-tests/vhost_web1/1.tst", "web1:\n  assertion: assertTrue\n")
+        self.write_file("apache/salt-check-tests/vhost_web2/1.tst", "web2:\n  assertion: assertTrue\n")
+        self.st.gather_files(state_dir)
+        val = [key for key, value in self.st.iter_tests(sls_names=["apache.vhost_web1"])]
+        self.assertEqual(val, ["common", "web1"])
+        self.st = StateTestLoader("/tmp")
+        self.st.gather_files(state_dir)
+        val = [key for key, value in self.st.iter_tests(sls_names=["apache.vhost_web2"])]
+        self.assertEqual(val, ["common", "by-key", "web2"])
+
+    def test_group_top_states_1(self):
+        val = SaltCheck.group_top_states(["apache.vhost_web1", "mysql", "apache.vhost_web2"])
+        self.assertEqual(val, [("apache", ["apache.vhost_web1", "apache.vhost_web2"]),
+                               ("mysql", ["mysql"])])
 
     #def test_load_file_1(self):
     #    val = self.st.load_file("/tmp/testfile.tst")
     #    self.assertNotEqual(val, None) 
 
+class ShardTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tests = dict(("test-{0}".format(i), {}) for i in range(50))
+
+    def tearDown(self):
+        pass
+
+    def test_parse_shard_1(self):
+        val = SuiteSharder.parse_shard("2/4")
+        self.assertEqual(val, (2, 4))
+
+    def test_parse_shard_2(self):
+        self.assertRaises(ValueError, SuiteSharder.parse_shard, "5/4")
+
+    def test_parse_shard_3(self):
+        self.assertRaises(ValueError, SuiteSharder.parse_shard, "two")
+
+    def test_select_1(self):
+        seen = []
+        for i in range(1, 4):
+            seen.extend(dict(SuiteSharder("{0}/3".format(i)).select("apache", self.tests.items())))
+        self.assertEqual(sorted(seen), sorted(self.tests))
+
+    def test_select_2(self):
+        val_1 = dict(SuiteSharder("1/3").select("apache", self.tests.items()))
+        val_2 = dict(SuiteSharder("1/3").select("apache", self.tests.items()))
+        self.assertEqual(val_1, val_2)
+
+    def test_select_weighted_1(self):
+        weights = {"apache": dict((name, float(i)) for i, name in enumerate(sorted(self.tests)))}
+        seen = []
+        loads = []
+        for i in range(1, 4):
+            selected = dict(SuiteSharder("{0}/3".format(i), weights).select("apache", self.tests.items()))
+            seen.extend(selected)
+            loads.append(sum(weights["apache"][name] for name in selected))
+        self.assertEqual(sorted(seen), sorted(self.tests))
+        self.assertLess(max(loads) - min(loads), 50)
+
+    def write_shard(self, tmpdir, name, contents):
+        path = os.path.join(tmpdir, name)
+        with open(path, 'w') as myfile:
+            if name.endswith('.json'):
+                json.dump(contents, myfile)
+            else:
+                yaml.safe_dump(contents, myfile)
+        return path
+
+    def test_merge_shards_1(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            paths = [self.write_shard(tmpdir, '1.json', {'local': {'apache': {'test-1': True},
+                                                                   'mysql': {'test-2': True}}}),
+                     self.write_shard(tmpdir, '2.json', {'local': {'apache': {'test-3': "False: no"},
+                                                                   'mysql': {}}}),
+                     self.write_shard(tmpdir, '3.yaml', {'apache': {'test-4': True},
+                                                         'nginx': {'test-5': True}})]
+            val = merge_shards(*paths)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(val, {'apache': {'test-1': True, 'test-3': "False: no", 'test-4': True},
+                               'mysql': {'test-2': True},
+                               'nginx': {'test-5': True}})
+        self.assertEqual(sum(len(results) for results in val.values()), 5)
+        self.assertEqual(len([result for results in val.values()
+                              for result in results.values() if result is not True]), 1)
+
+    def test_merge_shards_2(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # a test in two shards is kept once, from the last shard
+            paths = [self.write_shard(tmpdir, '1.json', {'local': {'apache': {'test-1': "False: no"}}}),
+                     self.write_shard(tmpdir, '2.json', {'local': {'apache': {'test-1': True}}}),
+                     self.write_shard(tmpdir, '3.json', ["not", "results"])]
+            val = merge_shards(*paths)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(val, {'apache': {'test-1': True}})
+
+class FilterTests(unittest.TestCase):
+
+    def test_matches_1(self):
+        val = SuiteFilter(include="apache-*").matches("apache-conf-exists", [])
+        self.assertEqual(val, True)
+
+    def test_matches_2(self):
+        val = SuiteFilter(include="apache-*", exclude="*-exists").matches("apache-conf-exists", [])
+        self.assertEqual(val, False)
+
+    def test_matches_3(self):
+        val = SuiteFilter(tags=["smoke", "web"]).matches("apache-conf-exists", ["web"])
+        self.assertEqual(val, True)
+
+    def test_matches_4(self):
+        val = SuiteFilter(tags="smoke,web").matches("apache-conf-exists", [])
+        self.assertEqual(val, False)
+
+    def test_is_active_1(self):
+        val = SuiteFilter().is_active()
+        self.assertEqual(val, False)
+
+class ResultCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        opts = {'cachedir': self.tmpdir,
+                'salt_check_cache_ttl': {'pkg': 3600, 'default': 60}}
+        self.rc = ResultCache(self.tmpdir, opts)
+        self.test = {"module_and_function": "pkg.version",
+                     "args": ["apache2"],
+                     "cacheable": True,
+                     "assertion": "assertEqual",
+                     "expected-return": "2.4.7"}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_ttl_1(self):
+        val = self.rc.get_ttl(self.test)
+        self.assertEqual(val, 3600)
+
+    def test_get_ttl_2(self):
+        self.test['module_and_function'] = 'file.file_exists'
+        val = self.rc.get_ttl(self.test)
+        self.assertEqual(val, 60)
+
+    def test_get_ttl_3(self):
+        del self.test['cacheable']
+        val = self.rc.get_ttl(self.test)
+        self.assertEqual(val, 0)
+
+    def test_get_1(self):
+        self.rc.put('apache', self.test, 3600, '2.4.7')
+        val = self.rc.get('apache', self.test, 3600)
+        self.assertEqual(val, (True, '2.4.7'))
+
+    def test_get_2(self):
+        self.rc.put('apache', self.test, 3600, '2.4.7')
+        self.rc.state_runs = [[time.time() + 1, set(['apache.vhost_web1'])]]
+        val = self.rc.get('apache', self.test, 3600)
+        self.assertEqual(val, (False, None))
+
+    def test_get_3(self):
+        self.rc.put('apache', self.test, 3600, '2.4.7')
+        self.rc.state_runs = [[time.time() + 1, set(['mysql'])]]
+        val = self.rc.get('apache', self.test, 3600)
+        self.assertEqual(val, (True, '2.4.7'))
+
+    def test_put_1(self):
+        # json would give back a list and a string key, which compare differently
+        for returned in [(2, 4), {1: 'a'}, [{'a': (1,)}], set([1]), ValueError('x')]:
+            self.rc.put('apache', self.test, 3600, returned)
+            self.assertEqual(self.rc.get('apache', self.test, 3600), (False, None))
+
+    def test_put_2(self):
+        returned = {'a': [1, 2.5, None, True], 'b': {'c': 'd'}}
+        self.rc.put('apache', self.test, 3600, returned)
+        self.rc.save()
+        val = ResultCache(self.tmpdir, {'cachedir': self.tmpdir}).get('apache', self.test, 3600)
+        self.assertEqual(val, (True, returned))
+
+    def test_hits_1(self):
+        self.rc.put('apache', self.test, 3600, '2.4.7')
+
+        def get():
+            for _ in range(500):
+                self.rc.get('apache', self.test, 3600)
+
+        threads = [threading.Thread(target=get) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.rc.hits, 2000)
+
+class RunHistoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def record_runs(self, runs):
+        for results in runs:
+            history = RunHistory(self.tmpdir)
+            for test_name, result, duration in results:
+                history.record('apache', test_name, result, duration)
+            history.close()
+
+    def query(self, name, **kwargs):
+        history = RunHistory(self.tmpdir)
+        rows = history.query(name, **kwargs)
+        history.conn.close()
+        return rows
+
+    def test_slowest_1(self):
+        self.record_runs([[('a', True, 1.0), ('b', True, 3.0)],
+                          [('a', True, 2.0), ('b', True, 5.0)]])
+        rows = self.query('slowest')
+        self.assertEqual([row['test'] for row in rows], ['b', 'a'])
+        self.assertEqual(rows[0]['average_duration'], 4.0)
+
+    def test_flakiest_1(self):
+        self.record_runs([[('a', True, 1), ('b', True, 1)],
+                          [('a', "False: no", 1), ('b', True, 1)]])
+        rows = self.query('flakiest')
+        self.assertEqual([row['test'] for row in rows], ['a'])
+
+    def test_changed_1(self):
+        self.record_runs([[('a', True, 1), ('b', "False: one", 1)],
+                          [('a', True, 1), ('b', "False: two", 1)]])
+        rows = self.query('changed')
+        self.assertEqual([row['test'] for row in rows], ['b'])
+
+    def test_prune_1(self):
+        self.record_runs([[('a', True, 1)]])
+        history = RunHistory(self.tmpdir, retention_days=0)
+        history.close()
+        self.assertEqual(self.query('slowest'), [])
+
+    def test_query_1(self):
+        history = RunHistory(self.tmpdir)
+        self.assertRaises(ValueError, history.query, 'fastest')
+        history.conn.close()
+
+
+class SchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.durations = SuiteDurations(self.tmpdir)
+        self.durations.record('apache', 'short', 1.0)
+        self.durations.record('apache', 'long', 9.0)
+        self.failures = SuiteFailures(self.tmpdir)
+        self.failures.record('apache', 'short', "False: no")
+        self.tests = [('short', {}), ('declared', {'duration': 5}), ('long', {}), ('new', {})]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def names(self, order):
+        scheduler = SuiteScheduler(self.durations, self.failures, order=order)
+        return [name for name, test in scheduler.order_tests('apache', self.tests)]
+
+    def test_order_1(self):
+        self.assertEqual(self.names('file'), ['short', 'declared', 'long', 'new'])
+
+    def test_order_2(self):
+        self.assertEqual(self.names('duration'), ['long', 'declared', 'new', 'short'])
+
+    def test_order_3(self):
+        self.assertEqual(self.names('failing'), ['short', 'long', 'declared', 'new'])
+
+    def test_order_4(self):
+        scheduler = SuiteScheduler(self.durations, self.failures, workers=4)
+        self.assertEqual(scheduler.order, 'duration')
+
+    def test_order_5(self):
+        self.assertRaises(ValueError, SuiteScheduler, self.durations, self.failures, order='random')
+
+    def test_run_1(self):
+        scheduler = SuiteScheduler(self.durations, self.failures, workers=3)
+        tests = [(str(i), {'module_and_function': 'test.echo'}) for i in range(10)]
+        val = sorted(outcome for outcome, resource_class, queued in scheduler.run(tests, lambda item: item[0]))
+        self.assertEqual(val, sorted(name for name, test in tests))
+
+    def test_run_2(self):
+        scheduler = SuiteScheduler(self.durations, self.failures, workers=4)
+        tests = [(str(i), {'module_and_function': 'pkg.version'}) for i in range(4)]
+        running = []
+
+        def run_one(item):
+            running.append(item)
+            time.sleep(0.01)
+            val = len(running)
+            running.remove(item)
+            return val
+        val = [outcome for outcome, resource_class, queued in scheduler.run(tests, run_one)]
+        self.assertEqual(val, [1, 1, 1, 1])
+        self.assertEqual(scheduler.queue_report()['pkg']['tests'], 4)
+
+    def test_resource_class_1(self):
+        opts = {'salt_check_resource_classes': {'service': 'pkg', 'cmd.run': 'shell'}}
+        scheduler = SuiteScheduler(self.durations, self.failures, opts=opts)
+        val = [scheduler.resource_class({'module_and_function': m_and_f})
+               for m_and_f in ['pkg.version', 'service.status', 'cmd.run', 'cmd.retcode', 'file.touch']]
+        self.assertEqual(val, ['pkg', 'pkg', 'shell', 'default', 'file'])
+
+    def test_resource_class_2(self):
+        scheduler = SuiteScheduler(self.durations, self.failures)
+        val = scheduler.resource_class({'module_and_function': 'cmd.run', 'resource_class': 'pkg'})
+        self.assertEqual(val, 'pkg')
+
+    def test_failures_1(self):
+        self.failures.record('apache', 'short', True)
+        self.failures.save()
+        self.assertFalse(SuiteFailures(self.tmpdir).is_failed('apache', 'short'))
+
+
+class ShellBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.batch = ShellBatch(None)
+
+    def test_is_batchable_1(self):
+        val = ShellBatch.is_batchable({'module_and_function': 'cmd.run', 'args': ['uptime']})
+        self.assertTrue(val)
+
+    def test_is_batchable_2(self):
+        val = ShellBatch.is_batchable({'module_and_function': 'cmd.run', 'args': ['uptime'],
+                                       'kwargs': {'runas': 'nobody'}})
+        self.assertFalse(val)
+
+    def test_is_batchable_3(self):
+        val = ShellBatch.is_batchable({'module_and_function': 'pkg.version', 'args': ['apache2']})
+        self.assertFalse(val)
+
+    def test_is_batchable_4(self):
+        # the shell would pipe, expand, redirect or run a builtin, cmd.run would not
+        for command in ['ls /tmp | wc -l', 'echo $HOME', 'ls /tmp/*', 'ls /nonexistent 2>/dev/null',
+                        'exit 3', 'cd /tmp', 'LANG=C ls', "echo 'a b'", 'no-such-program-salt-check']:
+            val = ShellBatch.is_batchable({'module_and_function': 'cmd.run', 'args': [command]})
+            self.assertFalse(val, command)
+
+    def test_split_1(self):
+        commands = ['echo -e one', 'ls /nonexistent-salt-check', 'true']
+        stdout = subprocess.check_output(['/bin/sh', '-c', self.batch.script(commands)])
+        val = self.batch.split(stdout.decode('utf-8').rstrip(), 3)
+        # what cmd.run without a shell gives: the words exec-ed, stderr with stdout, rstripped
+        alone = []
+        for command in commands:
+            proc = subprocess.Popen(command.split(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            out, err = proc.communicate()
+            alone.append((out.decode('utf-8').rstrip(), proc.returncode))
+        self.assertEqual(val, alone)
+        self.assertEqual(val[0], ('one', 0))
+        self.assertNotEqual(val[1][1], 0)
+
+    def test_split_2(self):
+        val = self.batch.split("one\n{} 0 0\ntwo".format(self.batch.token), 2)
+        self.assertEqual(val, [('one', 0), None])
+
+
+class FileCheckEngineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'hello')
+        with open(self.path, 'wb') as myfile:
+            myfile.write(b'hello')
+        self.engine = FileCheckEngine(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_test(self, m_and_f, *args):
+        return {'module_and_function': m_and_f, 'args': list(args)}
+
+    def test_parse_hash_1(self):
+        val = FileCheckEngine.parse_hash('5d41402abc4b2a76b9719d911017c592')
+        self.assertEqual(val, ('md5', '5d41402abc4b2a76b9719d911017c592'))
+
+    def test_parse_hash_2(self):
+        self.assertEqual(FileCheckEngine.parse_hash('sha1=abc'), ('sha1', 'abc'))
+        self.assertEqual(FileCheckEngine.parse_hash('abc'), None)
+        self.assertEqual(FileCheckEngine.parse_hash('nohash:abc'), None)
+        self.assertEqual(FileCheckEngine.parse_hash('new:abc'), None)
+
+    def test_run_1(self):
+        tests = [self.make_test('file.file_exists', self.path),
+                 self.make_test('file.file_exists', self.tmpdir),
+                 self.make_test('file.check_hash', self.path, 'md5:5d41402abc4b2a76b9719d911017c592'),
+                 self.make_test('file.check_hash', self.path, 'md5:00000000000000000000000000000000'),
+                 self.make_test('file.check_hash', self.path + '-missing', 'md5:5d41402abc4b2a76b9719d911017c592'),
+                 self.make_test('file.check_hash', self.path, 'abc')]
+        self.assertEqual(self.engine.run(tests), [True, False, True, False, None, None])
+
+    def test_run_3(self):
+        tests = [self.make_test('file.check_hash', self.path, 'md5:5d41402abc4b2a76b9719d911017c592')]
+        self.engine.hash_file = lambda path, size, hash_type: hashlib.new('nohash')
+        self.assertEqual(self.engine.run(tests), [None])
+
+    def test_run_2(self):
+        test = self.make_test('file.check_hash', self.path, 'md5:5d41402abc4b2a76b9719d911017c592')
+        self.engine.run([test])
+        self.engine.save()
+        with open(self.path, 'wb') as myfile:
+            myfile.write(b'hello world')
+        val = FileCheckEngine(self.tmpdir).run([test])
+        self.assertEqual(val, [False])
+
+    def test_is_native_1(self):
+        self.assertTrue(FileCheckEngine.is_native(self.make_test('file.file_exists', '/etc/hosts')))
+        self.assertFalse(FileCheckEngine.is_native(self.make_test('file.check_hash', '/etc/hosts')))
+        self.assertFalse(FileCheckEngine.is_native(self.make_test('file.directory_exists', '/etc')))
+
+
+class PillarCacheTests(unittest.TestCase):
+
+    @staticmethod
+    def pillar_items(pillar):
+        ret = {'role': 'web', 'apache': {'vhosts': [{'name': 'a'}, {'name': 'b'}]}}
+        ret.update(pillar)
+        return ret
+
+    def setUp(self):
+        self.caller = FakeSaltCheck({'pillar.items': self.pillar_items})
+        self.cache = PillarCache(self.caller)
+
+    def test_call_1(self):
+        val = self.cache.call('pillar.get', {'role': 'db'}, 'role')
+        self.assertEqual(val, 'db')
+
+    def test_call_2(self):
+        val = self.cache.call('pillar.get', {'role': 'db'}, 'apache:vhosts:1:name')
+        self.assertEqual(val, 'b')
+
+    def test_call_3(self):
+        val = self.cache.call('pillar.item', {'role': 'db'}, 'role', 'missing')
+        self.assertEqual(val, {'role': 'db', 'missing': ''})
+
+    def test_render_1(self):
+        self.cache.call('pillar.get', {'role': 'db', 'port': 80}, 'role')
+        self.cache.call('pillar.items', {'port': 80, 'role': 'db'})
+        self.cache.call('pillar.get', {'role': 'app'}, 'role')
+        self.assertEqual(len(self.caller.calls_of('pillar.items')), 2)
+
+    def test_can_answer_1(self):
+        self.assertTrue(PillarCache.can_answer('pillar.get', ['role', 'web'], {}))
+        self.assertFalse(PillarCache.can_answer('pillar.get', ['role'], {'merge': True}))
+        self.assertFalse(PillarCache.can_answer('pillar.raw', [], {}))
+
+
+class SuiteRendererTests(unittest.TestCase):
+
+    def render(self, contents, **kwargs):
+        return contents.replace("{{ grains['os'] }}", self.grains['os'])
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.grains = {'os': 'Ubuntu'}
+        self.caller = FakeSaltCheck({'grains.items': lambda: self.grains,
+                                     'pillar.raw': lambda: {},
+                                     'file.apply_template_on_contents': self.render})
+        self.path = os.path.join(self.tmpdir, 'a.tst')
+        with open(self.path, 'w') as myfile:
+            myfile.write("#!jinja|yaml\nos-{{ grains['os'] }}:\n  module_and_function: test.echo\n"
+                         "  assertion: assertEqual\n  expected-return: x\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def load(self):
+        renderer = SuiteRenderer(self.caller, self.tmpdir)
+        stl = StateTestLoader("/tmp", renderer=renderer)
+        names = [key for key, value in stl.iter_file(self.path)]
+        renderer.save()
+        return names
+
+    def test_is_template_1(self):
+        self.assertTrue(SuiteRenderer.is_template("#!jinja|yaml\n{% for x in y %}"))
+        self.assertTrue(SuiteRenderer.is_template("#! jinja | yaml\na: b\n"))
+        self.assertFalse(SuiteRenderer.is_template("a:\n  b: c\n"))
+        self.assertFalse(SuiteRenderer.is_template("#!yaml\na: b\n"))
+        # markup without the renderer line is read as it is
+        self.assertFalse(SuiteRenderer.is_template("a:\n  expected-return: '{{ x }}'\n"))
+        self.assertFalse(SuiteRenderer.is_template("a: b\n#!jinja|yaml\n"))
+
+    def test_render_4(self):
+        with open(self.path, 'w') as myfile:
+            myfile.write("literal:\n  module_and_function: cmd.run\n  args: echo '{{ x }}'\n"
+                         "  assertion: assertEqual\n  expected-return: '{{ x }}'\n")
+        self.assertEqual(self.load(), ['literal'])
+        self.assertEqual(self.caller.calls_of('file.apply_template_on_contents'), [])
+
+    def test_render_1(self):
+        self.assertEqual(self.load(), ['os-Ubuntu'])
+
+    def test_render_2(self):
+        self.load()
+        self.load()
+        self.assertEqual(len(self.caller.calls_of('file.apply_template_on_contents')), 1)
+
+    def test_save_1(self):
+        self.load()
+        mode = os.stat(os.path.join(self.tmpdir, 'rendered_tests.json')).st_mode & 0o777
+        self.assertEqual(mode, 0o600)
+
+    def test_render_3(self):
+        self.load()
+        self.grains = {'os': 'CentOS'}
+        self.assertEqual(self.load(), ['os-CentOS'])
+        self.assertEqual(len(self.caller.calls_of('file.apply_template_on_contents')), 2)
+
+
+class SpilledReturnTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        SpilledReturn.CHUNK_SIZE = 7
+        self.text = u"abcdefghij" * 10 + u"\u00e9 NEEDLE"
+        self.spilled = SpilledReturn(self.text, self.tmpdir)
+
+    def tearDown(self):
+        SpilledReturn.CHUNK_SIZE = 65536
+        shutil.rmtree(self.tmpdir)
+
+    def test_eq_1(self):
+        self.assertTrue(self.text == self.spilled)
+        self.assertFalse(self.text[:-1] + u"X" == self.spilled)
+        self.assertTrue(u"other" != self.spilled)
+
+    def test_contains_1(self):
+        self.assertTrue(u"NEEDLE" in self.spilled)
+        self.assertTrue(u"ghijabc" in self.spilled)
+        self.assertFalse(u"HAYSTACK" in self.spilled)
+
+    def test_str_1(self):
+        self.assertIn(self.spilled.digest, str(self.spilled))
+        self.assertNotIn(u"abcdefghij", str(self.spilled))
+
+    def test_discard_1(self):
+        self.spilled.discard()
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+
+class ProgressEventsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.caller = FakeSaltCheck({'event.send': lambda tag, data: True})
+
+    def events(self):
+        '''(tag, data) of every event fired'''
+        return [(args[0], kwargs['data']) for args, kwargs in self.caller.calls_of('event.send')]
+
+    def test_every_1(self):
+        progress = ProgressEvents(self.caller, every=3, interval=3600)
+        for i in range(7):
+            progress.add('apache', 'test-{}'.format(i), True if i != 4 else "False: no")
+        progress.finish()
+        val = [(data['total'], data['failed_tests'], data['finished']) for tag, data in self.events()]
+        self.assertEqual(val, [(3, {}, False), (6, {'apache': ['test-4']}, False), (7, {}, True)])
+
+    def test_interval_1(self):
+        progress = ProgressEvents(self.caller, every=100, interval=0)
+        progress.add('apache', 'test-1', True)
+        self.assertEqual(len(self.events()), 1)
+        self.assertEqual(self.events()[0][0], 'salt_check/progress')
+
+
+class EventuallyTests(unittest.TestCase):
+
+    def test_eventually_options_1(self):
+        self.assertEqual(SaltCheck.eventually_options(None), None)
+        self.assertEqual(SaltCheck.eventually_options(True), SaltCheck.EVENTUALLY)
+
+    def test_eventually_options_2(self):
+        val = SaltCheck.eventually_options({'timeout': 60, 'interval': 5})
+        self.assertEqual((val['timeout'], val['interval'], val['backoff']), (60, 5, 2))
+        self.assertEqual(SaltCheck.eventually_options(12)['timeout'], 12)
+
+    def test_eventually_options_3(self):
+        for value, message in [({'interval': 0}, "eventually interval must be more than 0"),
+                               ({'interval': -1, 'backoff': 1}, "eventually interval must be more than 0"),
+                               ({'max_interval': 0}, "eventually max_interval must be more than 0"),
+                               (-5, "eventually timeout must be more than 0"),
+                               ({'backoff': 0.5}, "eventually backoff must be at least 1"),
+                               ({'timeout': '30'}, "eventually must map backoff, interval, max_interval, timeout to numbers"),
+                               ({'interval': True}, "eventually must map backoff, interval, max_interval, timeout to numbers"),
+                               ('soon', "eventually must be True, a number of seconds or a dictionary"),
+                               ([30], "eventually must be True, a number of seconds or a dictionary")]:
+            with self.assertRaises(ValueError) as err:
+                SaltCheck.eventually_options(value)
+            self.assertEqual(str(err.exception), message)
+        self.assertEqual(SaltCheck.eventually_options({'backoff': 1, 'interval': 0.5})['backoff'], 1)
+        self.assertEqual(SaltCheck.eventually_options(0), None)
+
+    def test_schema_1(self):
+        test = {"module_and_function": "test.echo", "assertion": "assertEqual",
+                "expected-return": "x", "eventually": {"deadline": 5}}
+        self.assertEqual(len(StateTestLoader.check_test_schema(test)), 1)
+        test['eventually'] = {"timeout": 5}
+        self.assertEqual(StateTestLoader.check_test_schema(test), [])
+        test['eventually'] = {"interval": 0}
+        self.assertEqual(StateTestLoader.check_test_schema(test), ["eventually interval must be more than 0"])
+        test['eventually'] = "30s"
+        self.assertEqual(StateTestLoader.check_test_schema(test),
+                         ["eventually must be True, a number of seconds or a dictionary"])
+
+
+class GrainSelectorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.selector = GrainSelector({'os_family': 'Debian', 'os': 'Ubuntu',
+                                       'roles': ['web', 'db'], 'osrelease_info': [22, 4]})
+
+    def test_only_if_grains_1(self):
+        test = {'only_if_grains': {'os_family': 'debian', 'roles': 'web'}}
+        self.assertEqual(self.selector.skip_reason(test), None)
+
+    def test_only_if_grains_2(self):
+        test = {'only_if_grains': {'os_family': ['RedHat', 'Suse']}}
+        self.assertEqual(self.selector.skip_reason(test),
+                         "Skipped: grain os_family is Debian, not RedHat|Suse")
+
+    def test_unless_grains_1(self):
+        test = {'unless_grains': {'os': 'Ubu*', 'osrelease_info:0': 22}}
+        self.assertTrue(self.selector.skip_reason(test).startswith("Skipped: "))
+        test = {'unless_grains': {'os': 'Ubu*', 'osrelease_info:0': 20}}
+        self.assertEqual(self.selector.skip_reason(test), None)
+
+    def test_select_1(self):
+        tests = [('deb', {'only_if_grains': {'os_family': 'Debian'}}),
+                 ('rh', {'only_if_grains': {'os_family': 'RedHat'}}),
+                 ('plain', {})]
+        skipped = []
+        picked = list(self.selector.select(tests, {}, skipped))
+        self.assertEqual([name for name, test in picked], ['deb', 'plain'])
+        self.assertEqual([name for name, reason in skipped], ['rh'])
+
+    def test_schema_1(self):
+        test = {"module_and_function": "test.echo", "assertion": "assertEqual",
+                "expected-return": "x", "unless_grains": "Ubuntu"}
+        self.assertEqual(StateTestLoader.check_test_schema(test),
+                         ["unless_grains must map grains to values"])
+
+
+class CompiledTestTests(unittest.TestCase):
+
+    def compiled(self, expected, returned):
+        return CompiledTest('test-1', {}, True, lambda: returned, (), {},
+                            SaltCheck.assert_equal, True, expected,
+                            SaltCheck.cast_expected_to_return_types(expected))
+
+    def test_check_1(self):
+        compiled = self.compiled("5", 5)
+        self.assertTrue((int, 5) in compiled.expected_casts)
+        self.assertTrue((dict, "5") in compiled.expected_casts)
+        casts = compiled.expected_casts
+        self.assertEqual(compiled.check(compiled.call()), True)
+        self.assertTrue(compiled.expected_casts is casts)
+
+    def test_check_2(self):
+        compiled = self.compiled("False", False)
+        self.assertEqual(compiled.check(False), True)
+        self.assertNotEqual(compiled.check("True"), True)
+
+    def test_check_3(self):
+        # a type that is not cast when compiling is cast on each check
+        compiled = self.compiled("ab", ('a', 'b'))
+        self.assertEqual(compiled.check(compiled.call()), True)
+        self.assertFalse(tuple in [ret_type for ret_type, value in compiled.expected_casts])
+
+    def test_check_4(self):
+        compiled = self.compiled("5", 5)
+        results = []
+
+        def check():
+            for returned in [5, "5", 5.0, [5]] * 50:
+                results.append(compiled.check(returned))
+
+        threads = [threading.Thread(target=check) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results.count(True), 600)
+
+    def test_invalid_1(self):
+        val = CompiledTest.invalid('test-1', None)
+        self.assertEqual((val.valid, val.test_dict), (False, None))
+
+
+class SuitePlanTests(unittest.TestCase):
+
+    class Check(FakeSaltCheck):
+        '''compiles tests without salt, echoing their first arg'''
+
+        def __init__(self, cachedir):
+            FakeSaltCheck.__init__(self, {'grains.items': lambda: {}}, opts={'cachedir': cachedir},
+                                   cachedir=cachedir)
+            self.compiled = []
+
+        def compile_test(self, test_name, test_dict):
+            self.compiled.append(test_name)
+            return CompiledTest(test_name, test_dict, True, lambda arg: arg, tuple(test_dict['args']), {},
+                                SaltCheck.assert_equal, True, test_dict['expected-return'], ())
+
+        @staticmethod
+        def spill(returned):
+            return returned
+
+        check_return = staticmethod(SaltCheck.check_return)
+        eventually_options = staticmethod(SaltCheck.eventually_options)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.check = self.Check(self.tmpdir)
+        self.tests = [('test-{}'.format(i), {'module_and_function': 'pkg.version', 'args': [i],
+                                             'expected-return': i, 'duration': i})
+                      for i in range(4)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_plan_1(self):
+        suite_run = SuiteRun(self.check, workers=2, order='duration')
+        plan = suite_run.scheduler.order_tests('apache', suite_run.compile_plan({}, self.tests))
+        # compiled once each, before any test is scheduled
+        self.assertEqual(sorted(self.check.compiled), ['test-0', 'test-1', 'test-2', 'test-3'])
+        self.assertEqual([name for name, compiled in plan], ['test-3', 'test-2', 'test-1', 'test-0'])
+        run_one = functools.partial(suite_run.run_one, 'apache', {})
+        val = dict((outcome[0], (outcome[1], resource_class))
+                   for outcome, resource_class, queued in suite_run.scheduler.run(plan, run_one))
+        self.assertEqual(val['test-2'], (True, 'pkg'))
+        self.assertEqual(len(self.check.compiled), 4)
+
+    def test_plan_3(self):
+        testdir = os.path.join(self.tmpdir, 'apache', 'salt-check-tests')
+        os.makedirs(testdir)
+        test = "  module_and_function: test.echo\n  args: [x]\n  assertion: assertEqual\n  expected-return: x\n"
+        with open(os.path.join(testdir, '1.tst'), 'w') as myfile:
+            myfile.write("#!jinja|yaml\n{{ 'test-a' }}:\n" + test)
+        with open(os.path.join(testdir, '2.tst'), 'w') as myfile:
+            myfile.write("test-b:\n" + test)
+        threads = []
+        call_salt_command, compile_test = self.check.call_salt_command, self.check.compile_test
+
+        def record(func):
+            def call(*args, **kwargs):
+                threads.append(threading.current_thread().name)
+                return func(*args, **kwargs)
+            return call
+
+        self.check.search_paths = [self.tmpdir]
+        self.check.salt_functions.update({'pillar.raw': lambda: {},
+                                          'file.apply_template_on_contents':
+                                              lambda contents, **kwargs: contents.replace("{{ 'test-a' }}", 'test-a')})
+        self.check.call_salt_command = record(call_salt_command)
+        self.check.compile_test = record(compile_test)
+        val = SuiteRun(self.check, order='file').run_state('apache')
+        self.assertEqual(val, {'apache': {'test-a': True, 'test-b': True}})
+        # rendering and compiling stay on the thread running the tests
+        self.assertTrue(len(threads) >= 4)
+        self.assertEqual(set(threads), set([threading.current_thread().name]))
+
+    def test_plan_2(self):
+        suite_run = SuiteRun(self.check)
+        errors = {'test-1': ['assertion is required']}
+        plan = list(suite_run.compile_plan(errors, self.tests))
+        self.assertEqual(self.check.compiled, ['test-0', 'test-2', 'test-3'])
+        val = suite_run.run_one('apache', errors, plan[1])
+        self.assertEqual(val[1], "False: Invalid test: assertion is required")
+
+
+class SuiteValidatorTests(unittest.TestCase):
+
+    TEST = ("{}:\n  module_and_function: test.echo\n  args: [hi]\n"
+            "  assertion: assertEqual\n  expected-return: hi\n")
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.testdir = os.path.join(self.tmpdir, 'apache', 'salt-check-tests')
+        os.makedirs(self.testdir)
+        self.check = FakeSaltCheck({'sys.list_functions': lambda: ['test.echo']},
+                                   cachedir=self.tmpdir, search_paths=[self.tmpdir])
+        self.validator = SuiteValidator(self.check)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_file(self, name, contents):
+        with open(os.path.join(self.testdir, name), 'w') as myfile:
+            myfile.write(contents)
+
+    def errors(self, report):
+        return [(os.path.basename(err['file']), err['line'], err['test'], err['error'])
+                for err in report['errors']]
+
+    def test_validate_state_1(self):
+        self.write_file("1.tst", self.TEST.format("good") + "\n" +
+                        self.TEST.format("bad").replace("test.echo", "test.nope"))
+        report = self.validator.validate_state('apache')
+        self.assertEqual(report['tests'], 2)
+        self.assertEqual(self.errors(report),
+                         [("1.tst", 7, "bad", "test.nope is not available on this minion")])
+
+    def test_validate_state_2(self):
+        self.write_file("1.tst", self.TEST.format("test-a"))
+        self.write_file("2.tst", self.TEST.format("test-b") + self.TEST.format("test-a"))
+        report = self.validator.validate_state('apache')
+        val = self.errors(report)
+        self.assertEqual([err[:3] for err in val], [("2.tst", 6, "test-a")])
+        self.assertTrue(val[0][3].startswith("duplicate test name"))
+
+    def test_validate_state_3(self):
+        self.write_file("1.tst", self.TEST.format("test-a") + "test-b:\n  args: [unclosed\n")
+        report = self.validator.validate_state('apache')
+        self.assertEqual(len(report['errors']), 1)
+        self.assertEqual(report['errors'][0]['line'], 8)
+
+    def test_retcode_1(self):
+        self.write_file("1.tst", "test-a:\n  assertion: assertEqual\n")
+        reports = {'apache': self.validator.validate_state('apache')}
+        salt_check.__context__ = {}
+        try:
+            salt_check._set_retcode(reports)
+            self.assertEqual(salt_check.__context__, {'retcode': 1})
+            salt_check.__context__ = {}
+            salt_check._set_retcode({'apache': {'errors': []}})
+            self.assertEqual(salt_check.__context__, {})
+        finally:
+            del salt_check.__context__
+
+
+class ImportTimeTests(unittest.TestCase):
+    '''
+    The salt loader imports salt_check on every minion start and sys.list_modules,
+    so importing it has to stay cheap and must not pull in salt.client & co
+    '''
+    # what a minion has already imported when the loader gets to salt_check
+    CODE = ("import hashlib, json, logging, threading, yaml\n"
+            "try:\n    import salt.exceptions\nexcept ImportError:\n    pass\n"
+            "import salt_check\n")
+
+    def import_times(self):
+        '''return {module name: (self, cumulative) import time in microseconds} for importing salt_check'''
+        # a minion imports salt_check from its compiled bytecode
+        env = dict(os.environ)
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', self.CODE],
+                                cwd=os.path.abspath(sys.path[0]) + '/../', env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        times = {}
+        for line in err.decode('utf-8').splitlines():
+            # import time: self [us] | cumulative | imported package
+            bits = line.split('|')
+            if len(bits) != 3 or not bits[1].strip().isdigit():
+                continue
+            name = bits[2].strip()
+            times[name] = (int(bits[0].split(':')[-1]), int(bits[1]))
+        return times
+
+    def setUp(self):
+        if sys.version_info < (3, 7):
+            self.skipTest("-X importtime needs python 3.7")
+        # the first import may have to compile salt_check.py
+        self.import_times()
+
+    def test_import_time_1(self):
+        # what salt_check imports must cost less than twice salt_check itself; both slow
+        # down alike on a loaded machine, unlike a wall-clock budget. Best of three runs
+        runs = [self.import_times()['salt_check'] for _ in range(3)]
+        own = min(own for own, cumulative in runs)
+        imported = min(cumulative - own for own, cumulative in runs)
+        self.assertLess(imported, 2 * own)
+
+    def test_import_time_2(self):
+        val = self.import_times()
+        for module in ['salt.client', 'salt.minion', 'salt.config', 'salt.loader']:
+            self.assertNotIn(module, val)
+
 class MyClass(unittest.TestCase):
 
     def setUp(self):
@@ -138,6 +1219,15 @@ class MyClass(unittest.TestCase):
         val = self.mt.call_salt_command('test.ping', 'bad-arg')
         self.assertNotEqual(val, True) 
 
+    def test_salt_function_caller_1(self):
+        caller = SaltFunctionCaller({'test.echo': lambda text: text})
+        val = caller.function('test.echo', 'This works!')
+        self.assertEqual(val, 'This works!')
+
+    def test_salt_function_caller_2(self):
+        caller = SaltFunctionCaller({'test.echo': lambda text: text})
+        self.assertRaises(KeyError, caller.function, 'test.ping')
+
     def test_valid_module_1(self):
         val = self.mt.is_valid_module('invalid-name')
         self.assertEqual(val, False) 
@@ -223,6 +1313,52 @@ class MyClass(unittest.TestCase):
         fin_val = val.startswith('False')
         self.assertEqual(True, fin_val)
 
+    def test_4_assert_false(self):
+        val = SaltCheck.assert_false("False")
+        self.assertEqual(True, val)
+
+    def test_5_assert_false(self):
+        val = SaltCheck.assert_false("__import__('os')")
+        fin_val = val.startswith('False')
+        self.assertEqual(True, fin_val)
+
+    def test_compile_test_1(self):
+        mydict = {"module_and_function": "test.echo",
+                  "assertion": "assertEqual",
+                  "expected-return": "This works!",
+                  "args": ["This works!"] }
+        compiled = self.mt.compile_test("test-1", mydict)
+        self.assertEqual(compiled.valid, True)
+        self.assertEqual(compiled.check(compiled.call()), True)
+
+    def test_compile_test_2(self):
+        mydict = {"module_and_function": "invalidmod.invalidfunc",
+                  "assertion": "assertEqual",
+                  "expected-return": "This works!"}
+        compiled = self.mt.compile_test("test-1", mydict)
+        self.assertEqual(compiled.valid, False)
+
+    def test_check_eventually_1(self):
+        mydict = {"module_and_function": "test.echo",
+                  "assertion": "assertEqual",
+                  "expected-return": "This works!",
+                  "args": ["This works!"]}
+        compiled = self.mt.compile_test("test-1", mydict)
+        val = self.mt.check_eventually(compiled, SaltCheck.eventually_options(5))
+        self.assertEqual(val[:2], (True, 1))
+
+    def test_check_eventually_2(self):
+        mydict = {"module_and_function": "test.echo",
+                  "assertion": "assertEqual",
+                  "expected-return": "This works!",
+                  "args": ["Not yet"]}
+        compiled = self.mt.compile_test("test-1", mydict)
+        options = SaltCheck.eventually_options({'timeout': 0.3, 'interval': 0.1})
+        result, attempts, time_to_pass = self.mt.check_eventually(compiled, options)
+        self.assertNotEqual(result, True)
+        self.assertTrue(attempts > 1)
+        self.assertEqual(time_to_pass, None)
+
     def test_1_assert_in(self):
         val = SaltCheck.assert_in(1, [1,2,3])
         self.assertEqual(True, val)